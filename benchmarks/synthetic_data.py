@@ -0,0 +1,89 @@
+import random
+import sqlite3
+from typing import Any, Callable, Dict, List
+
+FILLER_PREFIX = "filler_"  # Extra non-PII columns added to widen the synthetic rows
+
+
+def get_key_columns(table: Dict[str, Any]) -> List[str]:
+    primary_key = table.get("primary_key") or []
+    return [primary_key] if isinstance(primary_key, str) else list(primary_key)
+
+
+def get_table_columns(table: Dict[str, Any], width: int) -> List[str]:
+    columns = get_key_columns(table)
+    columns += [col["column_name"] for col in table["columns"] if col["column_name"] not in columns]
+    return columns + [f"{FILLER_PREFIX}{index}" for index in range(width)]
+
+
+def build_value_factory(
+    table: Dict[str, Any], column_name: str, value_length: int
+) -> Callable[[int], Any]:
+    # Values stay inside the FF3 length bounds of the STRING alphabet the pipeline masks with
+    column = next((col for col in table["columns"] if col["column_name"] == column_name), {})
+    if column_name in get_key_columns(table):
+        if column.get("pii") == "Y":
+            return lambda n: f"K{n:09d}"
+        return lambda n: n
+    if column.get("pii") == "Y":
+        format_type = ((column.get("masking_algorithm") or {}).get("format") or "").upper()
+        if format_type == "DIGITS":
+            return lambda n: f"{n:010d}"
+        return lambda n: f"user{n:07d}@example.com"
+    return lambda n: f"{n:x}".rjust(value_length, "v")[:value_length]
+
+
+def generate_table(
+    connection: sqlite3.Connection,
+    table: Dict[str, Any],
+    rows: int,
+    width: int = 0,
+    cardinality: int = 0,
+    value_length: int = 16,
+    seed: int = 0,
+) -> None:
+    """Create one manifest table and fill it with rows of synthetic data.
+
+    cardinality bounds the distinct values of each non-key column, 0 makes every value unique.
+    """
+    rng = random.Random(f"{seed}:{table['table_name']}")
+    key_columns = get_key_columns(table)
+    columns = get_table_columns(table, width)
+    factories = [build_value_factory(table, column, value_length) for column in columns]
+    primary_key = f", PRIMARY KEY ({', '.join(key_columns)})" if key_columns else ""
+    connection.execute(f"DROP TABLE IF EXISTS {table['table_name']}")
+    connection.execute(f"CREATE TABLE {table['table_name']} ({', '.join(columns)}{primary_key})")
+
+    def make_row(row_number: int) -> tuple:
+        return tuple(
+            factory(
+                row_number
+                if column in key_columns or not cardinality
+                else rng.randrange(cardinality)
+            )
+            for column, factory in zip(columns, factories)
+        )
+
+    insert_query = (
+        f"INSERT INTO {table['table_name']} ({', '.join(columns)}) "
+        f"VALUES ({', '.join(['?'] * len(columns))})"
+    )
+    with connection:
+        connection.executemany(insert_query, (make_row(row_number) for row_number in range(rows)))
+
+
+def generate_database(
+    path: str,
+    tables: List[Dict[str, Any]],
+    rows: int,
+    width: int = 0,
+    cardinality: int = 0,
+    value_length: int = 16,
+    seed: int = 0,
+) -> None:
+    connection = sqlite3.connect(path)
+    try:
+        for table in tables:
+            generate_table(connection, table, rows, width, cardinality, value_length, seed)
+    finally:
+        connection.close()
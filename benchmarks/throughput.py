@@ -0,0 +1,335 @@
+"""Throughput benchmark of the masking pipeline against synthetic SQLite tables.
+
+Run from the project root, for example:
+
+    python -m benchmarks.throughput --rows 10000,100000 --width 8 --output results.json
+    python -m benchmarks.throughput --rows 10000 --baseline results.json
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import main.pii_data_masking_pipeline as pipeline
+from benchmarks.synthetic_data import generate_database, get_key_columns
+from db.db_factory import DBFactory
+from masking.masking_executor import shutdown_process_executor
+from masking.masking_plan import compile_table_plan
+from masking.masking_utils import clear_memos, get_memo_stats
+from utilities.utilities import load_pii_manifest
+
+STAGES = ("fetch", "mask", "write")
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_manifest(manifest: Dict[str, Any], args: argparse.Namespace) -> Dict[str, Any]:
+    # Same tables and masking settings, pointed at the synthetic database without side state
+    manifest = copy.deepcopy(manifest)
+    metadata = manifest["metadata"]
+    metadata.update(target_db="sqlite", strategy="upsert", checkpoint={"enabled": False})
+    if args.batch_size:
+        metadata["batch_size"] = args.batch_size
+    if args.executor:
+        metadata.setdefault("masking_executor", {})["mode"] = args.executor
+    tables = []
+    for table in manifest["tables"]:
+        if args.tables and table["table_name"] not in args.tables:
+            continue
+        # Synthetic rows need no extraction filter and have no watermark history
+        table = {
+            key: value
+            for key, value in table.items()
+            if key not in ("extraction_logic", "watermark")
+        }
+        if args.batch_size:
+            table["batch_size"] = args.batch_size
+        if not args.mask_keys:
+            # A masked key rewrites every row by delete and insert from one stream scan, a
+            # different path from the per-batch updates measured by default
+            key_columns = get_key_columns(table)
+            table["columns"] = [
+                dict(col, pii="N") if col["column_name"] in key_columns else col
+                for col in table["columns"]
+            ]
+        tables.append(table)
+    manifest["tables"] = tables
+    return manifest
+
+
+async def run_end_to_end(
+    table: Dict[str, Any], db_config: Dict[str, Any], manifest: Dict[str, Any]
+) -> float:
+    semaphore = asyncio.Semaphore(db_config.get("concurrency_limit", 3))
+    start = time.perf_counter()
+    try:
+        await pipeline.process_table(table, db_config, manifest, semaphore)
+        return time.perf_counter() - start
+    finally:
+        # The next run copies a fresh database over this one, so its connections are not reused
+        DBFactory.close_shared_clients()
+
+
+async def run_stages(
+    table: Dict[str, Any], db_config: Dict[str, Any], manifest: Dict[str, Any]
+) -> Dict[str, float]:
+    # Each stage runs to completion before the next, so its time is not hidden by the others
+    metadata = manifest["metadata"]
+    db_client = DBFactory.get_database_client(db_config, "target", metadata["target_db"])
+    try:
+        masking_plan = compile_table_plan(table, metadata)
+        table = dict(table, masking_plan=masking_plan)
+        key_columns = await pipeline.get_scan_key(db_client, table, metadata)
+        scan_mode = pipeline.get_scan_mode(table, metadata, key_columns)
+        if masking_plan.projection:
+            projected_columns = pipeline.get_projected_columns(masking_plan, key_columns)
+            if projected_columns:
+                table = dict(table, projected_columns=projected_columns)
+        batch_size = masking_plan.batch_size
+
+        start = time.perf_counter()
+        batches = [
+            batch
+            async for batch, _ in pipeline.iterate_batches(
+                db_client, table, table["schema"], scan_mode, key_columns, batch_size
+            )
+        ]
+        fetch_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        masked_batches = [await pipeline.mask_batch(table, batch, metadata) for batch in batches]
+        mask_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for batch, masked_batch in zip(batches, masked_batches):
+            await pipeline.write_batch(
+                db_client, table, masked_batch, metadata, key_columns, None, batch
+            )
+        write_seconds = time.perf_counter() - start
+    finally:
+        db_client.close()
+    return {"fetch": fetch_seconds, "mask": mask_seconds, "write": write_seconds}
+
+
+def summarize(
+    table_name: str, rows: int, args: argparse.Namespace, measurement: str, seconds: List[float]
+) -> Dict[str, Any]:
+    median_seconds = statistics.median(seconds)
+    return {
+        "table": table_name,
+        "rows": rows,
+        "width": args.width,
+        "cardinality": args.cardinality,
+        "measurement": measurement,
+        "seconds": [round(value, 6) for value in seconds],
+        "best_seconds": round(min(seconds), 6),
+        "median_seconds": round(median_seconds, 6),
+        "rows_per_second": round(rows / median_seconds, 1) if median_seconds else None,
+    }
+
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    baseline_rates = {
+        (
+            result["table"],
+            result["rows"],
+            result["width"],
+            result["cardinality"],
+            result["measurement"],
+        ): result["rows_per_second"]
+        for result in baseline["results"]
+    }
+    for result in results:
+        baseline_rate = baseline_rates.get(
+            (
+                result["table"],
+                result["rows"],
+                result["width"],
+                result["cardinality"],
+                result["measurement"],
+            )
+        )
+        if baseline_rate and result["rows_per_second"]:
+            result["baseline_rows_per_second"] = baseline_rate
+            result["change"] = round(result["rows_per_second"] / baseline_rate - 1, 4)
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    manifest = build_manifest(load_pii_manifest(args.manifest), args)
+    measurements = ["end_to_end"] if args.mode in ("end_to_end", "all") else []
+    if args.mode in ("stages", "all"):
+        measurements += list(STAGES)
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for rows in args.rows:
+            template_path = os.path.join(workdir, f"template_{rows}.db")
+            start = time.perf_counter()
+            generate_database(
+                template_path,
+                manifest["tables"],
+                rows,
+                args.width,
+                args.cardinality,
+                args.value_length,
+                args.seed,
+            )
+            logging.info(f"Generated {rows} rows per table in {time.perf_counter() - start:.2f}s")
+            for table in manifest["tables"]:
+                timings: Dict[str, List[float]] = {measurement: [] for measurement in measurements}
+                for _ in range(args.repeat):
+                    # Masking rewrites the table, so every run starts from a fresh copy
+                    for run_mode in ("end_to_end", "stages"):
+                        if args.mode not in (run_mode, "all"):
+                            continue
+                        work_path = os.path.join(workdir, "work.db")
+                        shutil.copyfile(template_path, work_path)
+                        db_config = {
+                            "concurrency_limit": args.concurrency,
+                            "target": {"sqlite": {"database_path": work_path}},
+                        }
+                        clear_memos()
+                        if run_mode == "end_to_end":
+                            timings["end_to_end"].append(
+                                await run_end_to_end(table, db_config, manifest)
+                            )
+                        else:
+                            for stage, seconds in (
+                                await run_stages(table, db_config, manifest)
+                            ).items():
+                                timings[stage].append(seconds)
+                results += [
+                    summarize(table["table_name"], rows, args, measurement, seconds)
+                    for measurement, seconds in timings.items()
+                ]
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+    return {
+        "benchmark": "throughput",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {
+            "manifest": args.manifest,
+            "tables": [table["table_name"] for table in manifest["tables"]],
+            "rows": args.rows,
+            "width": args.width,
+            "cardinality": args.cardinality,
+            "value_length": args.value_length,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "mode": args.mode,
+            "mask_keys": args.mask_keys,
+            "metadata": manifest["metadata"],
+        },
+        "results": results,
+        "memo_stats": get_memo_stats(),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--manifest",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "config", "pii_manifest.yaml"
+        ),
+        help="PII manifest whose tables and masking settings are benchmarked",
+    )
+    parser.add_argument(
+        "--tables", type=lambda value: value.split(","), help="Comma separated subset of tables"
+    )
+    parser.add_argument(
+        "--rows",
+        type=lambda value: [int(rows) for rows in value.split(",")],
+        default=[10000],
+        help="Comma separated row counts",
+    )
+    parser.add_argument("--width", type=int, default=0, help="Extra non-PII columns per table")
+    parser.add_argument(
+        "--value-length", type=int, default=16, help="Characters per extra column value"
+    )
+    parser.add_argument(
+        "--cardinality",
+        type=int,
+        default=0,
+        help="Distinct values per non-key column, 0 is all unique",
+    )
+    parser.add_argument("--batch-size", type=int, help="Overrides the manifest batch sizes")
+    parser.add_argument(
+        "--mask-keys",
+        action="store_true",
+        help="Keep primary keys the manifest masks as PII, they are left unmasked by default",
+    )
+    parser.add_argument(
+        "--executor", choices=("inline", "process"), help="Overrides masking_executor.mode"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=3, help="Concurrency limit for end to end runs"
+    )
+    parser.add_argument("--mode", choices=("end_to_end", "stages", "all"), default="all")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per measurement, the median is reported"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workdir", help="Directory for the generated databases, defaults to the system temp dir"
+    )
+    parser.add_argument(
+        "--baseline", help="Earlier results file to compare rows_per_second against"
+    )
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument(
+        "--log-level", default="WARNING", help="Level of the pipeline log while benchmarking"
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    # The pipeline logs every written batch at INFO, which would add to the measured time
+    logging.getLogger().setLevel(args.log_level.upper())
+    try:
+        report = asyncio.run(run_benchmark(args))
+    finally:
+        DBFactory.close_shared_clients()
+        shutdown_process_executor()
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
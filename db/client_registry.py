@@ -0,0 +1,50 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+from utilities.table_scheduler import PoolKey
+
+
+class ClientRegistry:
+    """Process-wide, thread-safe set of database clients, one per (role, database name), so every
+    table of a run shares the same connection pool instead of opening its own."""
+
+    def __init__(self):
+        self._clients: Dict[PoolKey, Tuple[Dict[str, Any], Any]] = {}
+        # Clients replaced by a new configuration, they may still be in use until shutdown
+        self._retired: List[Any] = []
+        self._lock = threading.Lock()
+
+    def get_or_create(
+        self, pool_key: PoolKey, config: Dict[str, Any], factory: Callable[[], Any]
+    ) -> Any:
+        with self._lock:
+            entry = self._clients.get(pool_key)
+            if entry is not None and entry[0] == config:
+                return entry[1]
+            if entry is not None:
+                logging.info(f"Configuration of {pool_key} changed, opening a new client")
+                self._retired.append(entry[1])
+            client = factory()
+            self._clients[pool_key] = (config, client)
+            logging.info(f"Opened shared {type(client).__name__} for {pool_key}")
+            return client
+
+    def close_all(self) -> None:
+        with self._lock:
+            clients = [client for _, client in self._clients.values()] + self._retired
+            self._clients.clear()
+            self._retired = []
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                logging.error(f"Closing {type(client).__name__} failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            clients = dict(self._clients)
+        return {
+            f"{role}.{db_name}": client.get_pool_stats()
+            for (role, db_name), (_, client) in clients.items()
+        }
@@ -1,22 +1,154 @@
+import asyncio
+import io
+import json
 import sqlite3
 import psycopg2
 import logging
 from psycopg2 import pool
+from psycopg2.extras import execute_values
 import os
+import re
+import threading
+import time
+import urllib.parse
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Optional, Sequence, Tuple
 
+from db.record_batch import RecordBatch
+from utilities.metrics import get_metrics
+
+
+KEY_SAMPLE_ROWS = 1000  # Keys sampled per partition to place the key range boundaries
+
+# A statement run in the transaction of a batch write, which is rolled back unless it changes a row
+WriteGuard = Optional[Tuple[str, Sequence[Any]]]
+
+
+class WriteGuardError(RuntimeError):
+    pass
+
+
+class BlockingIOClient:
+    """Runs a client's blocking calls on its own threads, so the event loop keeps serving other tables."""
+
+    def __init__(self):
+        self.io_threads = 1
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.pool_name = type(self).__name__  # Set to role.database by the shared client registry
+        self.wait_lock = threading.Lock()
+        self.calls = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.io_threads, thread_name_prefix=f"{type(self).__name__}-io"
+            )
+        return self.executor
+
+    async def run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+
+        def call():
+            # Every I/O thread holds at most one connection, so this is the wait for a free one
+            self.record_wait(time.perf_counter() - submitted)
+            return func(*args, **kwargs)
+
+        # Covers the wait for a free I/O thread as well as the driver call itself
+        with get_metrics().timer(
+            "db_call_seconds", client=type(self).__name__, call=getattr(func, "__name__", "call")
+        ):
+            return await loop.run_in_executor(self.get_executor(), call)
+
+    def record_wait(self, seconds: float) -> None:
+        get_metrics().observe("pool_wait_seconds", seconds, pool=self.pool_name)
+        with self.wait_lock:
+            self.calls += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        with self.wait_lock:
+            return {
+                "io_threads": self.io_threads,
+                "calls": self.calls,
+                "wait_seconds": round(self.wait_seconds, 6),
+                "mean_wait_seconds": round(self.wait_seconds / self.calls, 6) if self.calls else 0.0,
+                "max_wait_seconds": round(self.max_wait_seconds, 6),
+            }
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+class AbstractDatabaseClient(BlockingIOClient, ABC):
+    PLACEHOLDER = "%s"  # Parameter marker used by the driver
+    ROWID_COLUMN: Optional[str] = None  # Implicit row identifier usable for keyset scans
+    ROW_LOCK_CLAUSE = ""  # Ends a claiming subquery so concurrent claimers pass over locked rows
 
-class AbstractDatabaseClient(ABC):
     def __init__(self, config):
+        super().__init__()
         self.config = config
+        # set: load the batch into a staging table and apply one UPDATE ... FROM; row: one UPDATE per row
+        self.update_mode = config.get("update_mode", "set")
 
     @abstractmethod
     def get_connection(self):
         pass
 
+    async def execute_query(
+        self, query: str, batch_size: int, params: Sequence[Any] = ()
+    ) -> RecordBatch:
+        """Run the query and return its first batch of rows."""
+        return await self.run_blocking(self.fetch_first_batch, query, batch_size, params)
+
     @abstractmethod
-    async def execute_query(self, query: str, batch_size: int) -> List[Dict[str, Any]]:
+    def fetch_first_batch(
+        self, query: str, batch_size: int, params: Sequence[Any] = ()
+    ) -> RecordBatch:
+        pass
+
+    @abstractmethod
+    def stream_query(
+        self, query: str, batch_size: int, params: Sequence[Any] = ()
+    ) -> AsyncIterator[RecordBatch]:
+        """Run one long-lived query and yield its rows in batches until it is exhausted."""
+        pass
+
+    def get_key_range(self, table_name: str, key_column: str) -> Tuple[Any, Any]:
+        query = f"SELECT MIN({key_column}), MAX({key_column}) FROM {table_name}"
+        batch = self.fetch_first_batch(query, 1)
+        if not batch:
+            return None, None
+        low, high = batch.rows[0]
+        return low, high
+
+    def get_key_sample_query(self, table_name: str, key_column: str, sample_rows: int) -> str:
+        """Query selecting scan_key for about sample_rows rows spread over the table, or every row."""
+        return f"SELECT {key_column} AS scan_key FROM {table_name}"
+
+    def get_key_quantiles(self, table_name: str, key_column: str, partitions: int) -> List[Any]:
+        # Upper key of each of the first partitions - 1 equal-count buckets of a sample of the keys,
+        # sorting every key of a large table would cost about as much as masking it
+        sample_query = self.get_key_sample_query(
+            table_name, key_column, int(partitions) * KEY_SAMPLE_ROWS
+        )
+        query = (
+            f"SELECT MAX(scan_key) FROM (SELECT scan_key, NTILE({int(partitions)}) OVER (ORDER BY scan_key) AS bucket "
+            f"FROM ({sample_query}) sampled WHERE scan_key IS NOT NULL) buckets GROUP BY bucket ORDER BY bucket"
+        )
+        batch = self.fetch_first_batch(query, partitions) or RecordBatch([])
+        return [row[0] for row in batch.rows][:-1]
+
+    @abstractmethod
+    def execute_statements(self, statements: Sequence[Tuple[str, Sequence[Any]]]) -> int:
+        """Run the statements in one transaction and return the number of rows they changed."""
         pass
 
     @abstractmethod
@@ -27,16 +159,59 @@ class AbstractDatabaseClient(ABC):
     def get_primary_key(self, table_name: str) -> List[str]:
         pass
 
+    def estimate_row_count(self, table_name: str) -> Optional[int]:
+        # Exact count, clients with planner statistics try those first
+        batch = self.fetch_first_batch(f"SELECT COUNT(*) FROM {table_name}", 1)
+        return batch.rows[0][0] if batch else None
+
+    def get_referenced_tables(self, table_name: str) -> List[str]:
+        """Names of the tables the table's foreign keys point at."""
+        return []
+
     @abstractmethod
-    def bulk_insert(self, schema: str, table_name: str, batch: List[Dict[str, Any]], primary_key: List[str]) -> None:
+    def bulk_insert(
+        self,
+        schema: str,
+        table_name: str,
+        batch: RecordBatch,
+        primary_key: List[str],
+        delete_keys: Optional[List[Tuple[Any, ...]]] = None,
+        guard: WriteGuard = None,
+    ) -> None:
+        """Replace the rows identified by delete_keys (default: the batch's own keys) with the batch."""
         pass
 
     @abstractmethod
-    def bulk_update(self, schema: str, table_name: str, batch: List[Dict[str, Any]], primary_key: List[str]) -> None:
+    def bulk_update(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
         pass
 
+    @abstractmethod
+    def bulk_load(self, schema: str, table_name: str, batch: RecordBatch, guard: WriteGuard = None) -> None:
+        pass
+
+    @abstractmethod
+    def bulk_update_or_insert(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
+        pass
+
+    @staticmethod
+    def check_guard(cursor, guard: WriteGuard) -> None:
+        # Runs ahead of the batch in its transaction, so the batch commits only while the guard holds
+        if guard is None:
+            return
+        query, params = guard
+        cursor.execute(query, params)
+        if cursor.rowcount < 1:
+            raise WriteGuardError(f"Write guard changed no row, batch rolled back: {query}")
+
 
 class SQLiteClient(AbstractDatabaseClient):
+    PLACEHOLDER = "?"
+    ROWID_COLUMN = "rowid"
+
     def __init__(self, config):
         super().__init__(config)
         # Resolve the database path, supporting environment variables and relative paths
@@ -49,26 +224,207 @@ class SQLiteClient(AbstractDatabaseClient):
         # Ensure directory exists
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         logging.debug(f"SQLite db path - {self.db_path}")
-        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.busy_timeout = float(config.get("busy_timeout", 30))
+        # WAL lets readers and the single writer proceed concurrently, None keeps the file's mode
+        self.journal_mode = config.get("journal_mode", "wal")
+        # A read only client opens the file as it is, never creating it or changing its journal mode
+        self.read_only = bool(config.get("read_only", False))
+        # One connection per I/O thread, opened on first use, so a client shared by several tables
+        # reads in parallel while SQLite still admits one writer at a time
+        self.io_threads = int(config.get("max_connections", 1))
+        self.local = threading.local()
+        self.connections: List[sqlite3.Connection] = []
+        self.functions: Dict[str, Tuple[Any, int]] = {}
+        self.connections_lock = threading.Lock()
+
+    def open_connection(self) -> sqlite3.Connection:
+        if self.read_only:
+            return sqlite3.connect(
+                f"file:{urllib.parse.quote(self.db_path)}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+                timeout=self.busy_timeout,
+            )
+        connection = sqlite3.connect(self.db_path, check_same_thread=False, timeout=self.busy_timeout)
+        if self.journal_mode:
+            connection.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        return connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.open_connection()
+            with self.connections_lock:
+                for name, (mask_value, num_args) in self.functions.items():
+                    connection.create_function(name, num_args, mask_value, deterministic=True)
+                self.connections.append(connection)
+            self.local.connection = connection
+        return connection
 
     def get_connection(self):
         logging.debug("Getting connection for SQLite")
         return self.connection
 
-    async def execute_query(self, query: str, batch_size: int) -> List[Dict[str, Any]]:
+    def close(self) -> None:
+        super().close()
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+
+    def fetch_first_batch(
+        self, query: str, batch_size: int, params: Sequence[Any] = ()
+    ) -> RecordBatch:
         cursor = self.connection.cursor()
         logging.debug("Executing query: %s", query)
         try:
-            cursor.execute(query)
+            cursor.execute(query, params)
+            batch = RecordBatch([column[0] for column in cursor.description], cursor.fetchmany(batch_size))
+            logging.debug("Fetched batch of size: %d", len(batch))
+            return batch
+        except sqlite3.Error as e:
+            logging.error(f"SQLite query execution failed: {str(e)}")
+            raise
+        finally:
+            cursor.close()
+
+    async def stream_query(
+        self, query: str, batch_size: int, params: Sequence[Any] = ()
+    ) -> AsyncIterator[RecordBatch]:
+        # A separate read connection steps through the statement, so in WAL mode the open read
+        # does not block commits made by this client or by other key ranges of the same table
+        read_connection = await self.run_blocking(self.open_connection)
+        cursor = read_connection.cursor()
+        logging.debug("Streaming query: %s", query)
+        try:
+            await self.run_blocking(cursor.execute, query, params)
+            column_names = [column[0] for column in cursor.description]
             while True:
-                rows = cursor.fetchmany(batch_size)
+                rows = await self.run_blocking(cursor.fetchmany, batch_size)
                 if not rows:
                     break
-                batch = [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
-                logging.debug("Fetched batch of size: %d", len(batch))
-                return batch
+                yield RecordBatch(column_names, rows)
         except sqlite3.Error as e:
-            logging.error(f"SQLite query execution failed: {str(e)}")
+            logging.error(f"SQLite streaming query failed: {str(e)}")
+            raise
+        finally:
+            cursor.close()
+            await self.run_blocking(read_connection.close)
+
+    def register_masking_function(self, name: str, mask_value, num_args: int = 2) -> None:
+        # Deterministic lets SQLite treat the function like a built-in when planning queries,
+        # connections opened later by other I/O threads register it as well
+        with self.connections_lock:
+            self.functions[name] = (mask_value, num_args)
+            for connection in self.connections:
+                connection.create_function(name, num_args, mask_value, deterministic=True)
+        logging.debug(f"Registered SQLite masking function {name}")
+
+    def mask_table_in_database(
+        self,
+        table_name: str,
+        assignments: Dict[str, str],
+        where_clause: str = "",
+        params: Sequence[Any] = (),
+    ) -> int:
+        # One set-based UPDATE in one transaction, rows never leave SQLite
+        update_query = (
+            f"UPDATE {table_name} SET {', '.join([f'{column} = {expression}' for column, expression in assignments.items()])}"
+            f"{f' WHERE {where_clause}' if where_clause else ''}"
+        )
+        pragmas = self.config.get("bulk_pragmas", {"synchronous": "OFF", "temp_store": "MEMORY", "cache_size": -262144})
+        previous = {
+            pragma: self.connection.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in pragmas
+        }
+        try:
+            for pragma, value in pragmas.items():
+                self.connection.execute(f"PRAGMA {pragma} = {value}")
+            logging.debug("Executing in-database masking query: %s", update_query)
+            with self.connection:
+                updated_rows = self.connection.execute(update_query, params).rowcount
+            logging.info(f"Masked {updated_rows} rows in SQLite table {table_name} in the database")
+            return updated_rows
+        except sqlite3.Error as e:
+            logging.error(f"SQLite in-database masking failed: {str(e)}")
+            raise
+        finally:
+            for pragma, value in previous.items():
+                self.connection.execute(f"PRAGMA {pragma} = {value}")
+
+    def execute_statements(self, statements: Sequence[Tuple[str, Sequence[Any]]]) -> int:
+        try:
+            # BEGIN IMMEDIATE takes the write lock up front, so reads in the transaction stay valid
+            self.connection.execute("BEGIN IMMEDIATE")
+            changed_rows = sum(self.connection.execute(query, params).rowcount for query, params in statements)
+            self.connection.commit()
+            return changed_rows
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            logging.error(f"SQLite statements failed: {str(e)}")
+            raise
+
+    def table_exists(self, table_name: str) -> bool:
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+            ).fetchone()
+            is not None
+        )
+
+    def create_shadow_table(self, table_name: str, shadow_table: str) -> None:
+        # Same definition as the table, so key and column constraints hold while rows are copied,
+        # its other indexes and triggers are only created at the swap
+        row = self.connection.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+        ).fetchone()
+        if row is None:
+            raise ValueError(f"SQLite table {table_name} not found")
+        create_query = re.sub(
+            r"^CREATE\s+TABLE\s+(?:\"[^\"]+\"|\[[^\]]+\]|`[^`]+`|\S+?)(?=\s*\()",
+            f"CREATE TABLE {shadow_table}",
+            row[0],
+            count=1,
+            flags=re.IGNORECASE,
+        )
+        self.execute_statements([(f"DROP TABLE IF EXISTS {shadow_table}", ()), (create_query, ())])
+        logging.info(f"Created SQLite shadow table {shadow_table} for {table_name}")
+
+    def swap_shadow_table(self, table_name: str, shadow_table: str) -> bool:
+        """Replace the table by its shadow in one transaction, False if there is no shadow."""
+        if not self.table_exists(shadow_table):
+            return False
+        definitions = self.connection.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+            "AND sql IS NOT NULL ORDER BY type",
+            (table_name,),
+        ).fetchall()
+        # Both pragmas only change outside a transaction: dropping a referenced table must not
+        # delete or check its referencing rows, and the rename must leave views and other tables'
+        # foreign keys naming the table as they are
+        previous = {
+            pragma: self.connection.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in ("foreign_keys", "legacy_alter_table")
+        }
+        self.connection.execute("PRAGMA foreign_keys = OFF")
+        self.connection.execute("PRAGMA legacy_alter_table = ON")
+        try:
+            # Readers see the old table or the masked one, indexes are built once over all rows
+            self.execute_statements(
+                [
+                    (f"DROP TABLE {table_name}", ()),
+                    (f"ALTER TABLE {shadow_table} RENAME TO {table_name}", ()),
+                ]
+                + [(definition, ()) for (definition,) in definitions]
+            )
+        finally:
+            for pragma, value in previous.items():
+                self.connection.execute(f"PRAGMA {pragma} = {int(value)}")
+        logging.info(
+            f"Swapped SQLite shadow table into {table_name}, rebuilt {len(definitions)} "
+            f"indexes and triggers"
+        )
+        return True
 
     def delete_unwanted_data(self, table):
         try:
@@ -79,6 +435,7 @@ class SQLiteClient(AbstractDatabaseClient):
             self.connection.commit()
             logging.info(f"Deleted unwanted data from SQLite for table {table['table_name']}")
         except sqlite3.Error as e:
+            self.connection.rollback()
             logging.error(f"SQLite delete operation failed: {str(e)}")
 
     def get_primary_key(self, table_name):
@@ -94,73 +451,411 @@ class SQLiteClient(AbstractDatabaseClient):
             logging.error(f"Failed to retrieve primary key for table {table_name}: {str(e)}")
             return []
 
-    def bulk_insert(self, schema: str, table_name: str, batch: List[Dict[str, Any]], primary_key: List[str]) -> None:
+    def estimate_row_count(self, table_name: str) -> Optional[int]:
+        # sqlite_stat1 exists once ANALYZE has run, the first number of a stat is the table's rows
+        try:
+            row = self.connection.execute(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table_name,)
+            ).fetchone()
+            if row and row[0]:
+                return int(row[0].split()[0])
+        except (sqlite3.Error, ValueError):
+            pass  # Never analyzed, fall back to counting
+        return super().estimate_row_count(table_name)
+
+    def get_referenced_tables(self, table_name: str) -> List[str]:
+        try:
+            rows = self.connection.execute(f"PRAGMA foreign_key_list({table_name})").fetchall()
+            return sorted({row[2] for row in rows})  # The third element is the referenced table
+        except sqlite3.Error as e:
+            logging.error(f"Failed to retrieve foreign keys for table {table_name}: {str(e)}")
+            return []
+
+    def get_key_sample_query(self, table_name: str, key_column: str, sample_rows: int) -> str:
+        # The keys at evenly spaced rowids, each found by one seek of the table's b-tree
+        try:
+            low, high = self.connection.execute(
+                f"SELECT MIN(rowid), MAX(rowid) FROM {table_name}"
+            ).fetchone()
+        except sqlite3.Error:
+            low = high = None  # A WITHOUT ROWID table
+        if low is None or high - low < sample_rows:
+            return super().get_key_sample_query(table_name, key_column, sample_rows)
+        return (
+            f"WITH RECURSIVE probe(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM probe WHERE n + 1 < {sample_rows}) "
+            f"SELECT (SELECT {key_column} FROM {table_name} WHERE rowid >= {low} + ({high - low} * n) / {sample_rows} "
+            f"ORDER BY rowid LIMIT 1) AS scan_key FROM probe"
+        )
+
+    def bulk_insert(
+        self,
+        schema: str,
+        table_name: str,
+        batch: RecordBatch,
+        primary_key: List[str],
+        delete_keys: Optional[List[Tuple[Any, ...]]] = None,
+        guard: WriteGuard = None,
+    ) -> None:
+        if not batch:
+            return
         try:
             cursor = self.connection.cursor()
+            self.check_guard(cursor, guard)
             # Delete existing rows based on primary key before inserting
-            for row in batch:
-                delete_query = f"DELETE FROM {table_name} WHERE {' AND '.join([f'{pk} = ?' for pk in primary_key])}"
-                logging.debug("Executing delete query for bulk insert: %s", delete_query)
-                cursor.execute(delete_query, tuple(row[pk] for pk in primary_key))
+            delete_query = f"DELETE FROM {table_name} WHERE {' AND '.join([f'{pk} = ?' for pk in primary_key])}"
+            logging.debug("Executing delete query for bulk insert: %s", delete_query)
+            cursor.executemany(delete_query, delete_keys if delete_keys is not None else batch.keys(primary_key))
             # Insert new rows
             insert_query = (
-                f"INSERT INTO {table_name} ({', '.join(batch[0].keys())}) VALUES ({', '.join(['?'] * len(batch[0]))})"
+                f"INSERT INTO {table_name} ({', '.join(batch.columns)}) VALUES ({', '.join(['?'] * len(batch.columns))})"
             )
             logging.debug("Executing bulk insert query: %s", insert_query)
-            cursor.executemany(insert_query, [tuple(row.values()) for row in batch])
+            cursor.executemany(insert_query, batch.rows)
             self.connection.commit()
             logging.info(f"Bulk inserted rows into SQLite table {table_name}")
-        except sqlite3.Error as e:
+        except (sqlite3.Error, WriteGuardError) as e:
+            self.connection.rollback()
             logging.error(f"SQLite bulk insert failed: {str(e)}")
+            raise
 
-    def bulk_update(self, schema: str, table_name: str, batch: List[Dict[str, Any]], primary_key: List[str]) -> None:
+    def bulk_update(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
+        if not batch:
+            return
+        # UPDATE ... FROM needs SQLite 3.33+, older libraries keep the row-by-row path
+        if self.update_mode == "row" or sqlite3.sqlite_version_info < (3, 33, 0):
+            self.bulk_update_rowwise(schema, table_name, batch, primary_key, guard)
+            return
         try:
             cursor = self.connection.cursor()
-            for row in batch:
-                update_query = f"UPDATE {table_name} SET {', '.join([f'{key} = ?' for key in row.keys() if key not in primary_key])} WHERE {' AND '.join([f'{pk} = ?' for pk in primary_key])}"
-                params = [value for key, value in row.items() if key not in primary_key] + [row[pk] for pk in primary_key]
-                logging.debug("Executing update query: %s with params: %s", update_query, params)
-                cursor.execute(update_query, params)
+            self.check_guard(cursor, guard)
+            columns = list(batch.columns)
+            staging_table = f"staging_{table_name}"
+            cursor.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {staging_table} AS SELECT {', '.join(columns)} FROM {table_name} WHERE 0"
+            )
+            cursor.execute(f"DELETE FROM {staging_table}")
+            cursor.executemany(
+                f"INSERT INTO {staging_table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+                batch.rows,
+            )
+            update_query = (
+                f"UPDATE {table_name} SET {', '.join([f'{key} = {staging_table}.{key}' for key in columns if key not in primary_key])} "
+                f"FROM {staging_table} WHERE {' AND '.join([f'{table_name}.{pk} = {staging_table}.{pk}' for pk in primary_key])}"
+            )
+            logging.debug("Executing set-based update query: %s", update_query)
+            cursor.execute(update_query)
             self.connection.commit()
             logging.info(f"Bulk updated rows in SQLite table {table_name}")
-        except sqlite3.Error as e:
+        except (sqlite3.Error, WriteGuardError) as e:
+            self.connection.rollback()
             logging.error(f"SQLite bulk update failed: {str(e)}")
+            raise
+
+    def bulk_update_rowwise(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
+        try:
+            cursor = self.connection.cursor()
+            self.check_guard(cursor, guard)
+            value_columns = [key for key in batch.columns if key not in primary_key]
+            update_query = f"UPDATE {table_name} SET {', '.join([f'{key} = ?' for key in value_columns])} WHERE {' AND '.join([f'{pk} = ?' for pk in primary_key])}"
+            positions = [batch.column_index[key] for key in value_columns + list(primary_key)]
+            logging.debug("Executing update query: %s", update_query)
+            cursor.executemany(update_query, [tuple(row[position] for position in positions) for row in batch.rows])
+            self.connection.commit()
+            logging.info(f"Bulk updated rows in SQLite table {table_name}")
+        except (sqlite3.Error, WriteGuardError) as e:
+            self.connection.rollback()
+            logging.error(f"SQLite bulk update failed: {str(e)}")
+            raise
+
+    def bulk_load(self, schema: str, table_name: str, batch: RecordBatch, guard: WriteGuard = None) -> None:
+        if not batch:
+            return
+        try:
+            cursor = self.connection.cursor()
+            self.check_guard(cursor, guard)
+            columns = list(batch.columns)
+            insert_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+            logging.debug("Executing bulk load query: %s", insert_query)
+            cursor.executemany(insert_query, batch.rows)
+            self.connection.commit()
+            logging.info(f"Bulk loaded rows into SQLite table {table_name}")
+        except (sqlite3.Error, WriteGuardError) as e:
+            self.connection.rollback()
+            logging.error(f"SQLite bulk load failed: {str(e)}")
+            raise
+
+    def bulk_update_or_insert(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
+        if not batch:
+            return
+        try:
+            cursor = self.connection.cursor()
+            self.check_guard(cursor, guard)
+            columns = list(batch.columns)
+            upsert_query = (
+                f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))}) "
+                f"ON CONFLICT ({', '.join(primary_key)}) DO UPDATE SET "
+                f"{', '.join([f'{key} = excluded.{key}' for key in columns if key not in primary_key])}"
+            )
+            logging.debug("Executing bulk upsert query: %s", upsert_query)
+            cursor.executemany(upsert_query, batch.rows)
+            self.connection.commit()
+            logging.info(f"Bulk upserted rows into SQLite table {table_name}")
+        except (sqlite3.Error, WriteGuardError) as e:
+            self.connection.rollback()
+            logging.error(f"SQLite bulk upsert failed: {str(e)}")
+            raise
 
 
 class PostgresClient(AbstractDatabaseClient):
+    ROW_LOCK_CLAUSE = " FOR UPDATE SKIP LOCKED"
+
     def __init__(self, config):
         super().__init__(config)
-        self.pool = pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=5,
-            dbname=config["database"],
-            user=config["username"],
-            password=config["password"],
-            host=config["host"],
-            port=config["port"],
-        )
+        max_connections = int(config.get("max_connections", 5))
+        self.connect_args = {
+            "dbname": config["database"],
+            "user": config["username"],
+            "password": config["password"],
+            "host": config["host"],
+            "port": config["port"],
+        }
+        # Connections are handed out from several I/O threads, so the pool must be thread-safe.
+        # Each thread holds at most one connection during a call, so the pool never runs dry
+        self.pool = pool.ThreadedConnectionPool(minconn=1, maxconn=max_connections, **self.connect_args)
+        self.io_threads = max_connections
+        # Rows a server-side cursor transfers per network round trip
+        self.itersize = int(config.get("itersize", 2000))
+        # Column kinds COPY encodes differently, per table, read once from the catalog
+        self.copy_column_types: Dict[str, Dict[str, Optional[str]]] = {}
         logging.debug("PostgresClient initialized with config: %s", config)
 
     def get_connection(self):
         logging.debug("Getting connection from Postgres connection pool")
         return self.pool.getconn()
 
-    async def execute_query(self, query: str, batch_size: int) -> List[Dict[str, Any]]:
+    def close(self) -> None:
+        super().close()
+        self.pool.closeall()
+
+    def fetch_first_batch(
+        self, query: str, batch_size: int, params: Sequence[Any] = ()
+    ) -> RecordBatch:
         connection = None
         try:
             connection = self.get_connection()
             cursor = connection.cursor()
             logging.debug("Executing query: %s", query)
-            cursor.execute(query)
+            cursor.execute(query, params or None)
+            batch = RecordBatch([column[0] for column in cursor.description], cursor.fetchmany(batch_size))
+            logging.debug("Fetched batch of size: %d", len(batch))
+            connection.commit()
+            return batch
+        except psycopg2.Error as e:
+            if connection:
+                connection.rollback()
+            logging.error(f"Postgres query execution failed: {str(e)}")
+            raise
+        finally:
+            if connection:
+                self.pool.putconn(connection)
+                logging.debug("Released Postgres connection back to pool")
+
+    async def stream_query(
+        self, query: str, batch_size: int, params: Sequence[Any] = ()
+    ) -> AsyncIterator[RecordBatch]:
+        # A named cursor keeps the result set on the server, rows arrive itersize at a time. It holds
+        # its connection between batches, so it gets its own rather than one of the pool's
+        connection = None
+        try:
+            connection = await self.run_blocking(psycopg2.connect, **self.connect_args)
+            cursor = connection.cursor(name=f"stream_{uuid.uuid4().hex}")
+            cursor.itersize = self.itersize
+            logging.debug("Streaming query: %s", query)
+            await self.run_blocking(cursor.execute, query, params or None)
+            column_names = None
+            pending: List[Any] = []
             while True:
-                rows = cursor.fetchmany(batch_size)
+                # Network round trips follow itersize, yielded batches follow batch_size
+                rows = await self.run_blocking(cursor.fetchmany, self.itersize)
+                pending.extend(rows)
+                if column_names is None and cursor.description:
+                    column_names = [column[0] for column in cursor.description]
+                while len(pending) >= batch_size or (pending and not rows):
+                    chunk, pending = pending[:batch_size], pending[batch_size:]
+                    yield RecordBatch(column_names, chunk)
                 if not rows:
                     break
-                batch = [dict(zip([column[0] for column in cursor.description], row)) for row in rows]
-                logging.debug("Fetched batch of size: %d", len(batch))
-                yield batch
+            await self.run_blocking(cursor.close)
+            await self.run_blocking(connection.commit)
         except psycopg2.Error as e:
-            logging.error(f"Postgres query execution failed: {str(e)}")
+            logging.error(f"Postgres streaming query failed: {str(e)}")
+            raise
+        finally:
+            if connection:
+                # Ends the cursor's transaction if the consumer stopped early or the query failed
+                await self.run_blocking(connection.close)
+                logging.debug("Closed Postgres streaming connection")
+
+    def execute_statements(self, statements: Sequence[Tuple[str, Sequence[Any]]]) -> int:
+        connection = None
+        try:
+            connection = self.get_connection()
+            cursor = connection.cursor()
+            changed_rows = 0
+            for query, params in statements:
+                cursor.execute(query, params or None)
+                changed_rows += max(cursor.rowcount, 0)
+            connection.commit()
+            return changed_rows
+        except psycopg2.Error as e:
+            if connection:
+                connection.rollback()
+            logging.error(f"Postgres statements failed: {str(e)}")
+            raise
+        finally:
+            if connection:
+                self.pool.putconn(connection)
+                logging.debug("Released Postgres connection back to pool")
+
+    def create_shadow_table(self, table_name: str, shadow_table: str) -> None:
+        # Views are bound to the table itself, not its name, so they would keep the old rows
+        batch = self.fetch_first_batch(
+            "SELECT DISTINCT r.ev_class::regclass::text FROM pg_depend d "
+            "JOIN pg_rewrite r ON r.oid = d.objid WHERE d.classid = 'pg_rewrite'::regclass "
+            "AND d.refobjid = to_regclass(%s) AND r.ev_class <> d.refobjid",
+            1000,
+            (table_name,),
+        )
+        if batch:
+            raise ValueError(
+                f"Postgres table {table_name} is used by views {', '.join(row[0] for row in batch.rows)}, "
+                "it cannot be rebuilt"
+            )
+        # Columns, defaults and NOT NULL only, indexes and constraints are built at the swap
+        self.execute_statements(
+            [
+                (f"DROP TABLE IF EXISTS {shadow_table}", ()),
+                (
+                    f"CREATE TABLE {shadow_table} "
+                    f"(LIKE {table_name} INCLUDING ALL EXCLUDING INDEXES EXCLUDING CONSTRAINTS)",
+                    (),
+                ),
+            ]
+        )
+        logging.info(f"Created Postgres shadow table {shadow_table} for {table_name}")
+
+    def swap_shadow_table(self, table_name: str, shadow_table: str) -> bool:
+        """Replace the table by its shadow in one transaction, False if there is no shadow."""
+        connection = None
+        try:
+            connection = self.get_connection()
+            cursor = connection.cursor()
+            cursor.execute("SELECT to_regclass(%s)", (shadow_table,))
+            if cursor.fetchone()[0] is None:
+                connection.commit()
+                return False
+
+            # Indexes and constraints are built on the shadow under temporary names first, the
+            # table stays readable and writable until it is locked for the swap itself
+            renames = []
+            cursor.execute(
+                "SELECT quote_ident(conname), pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'u', 'x', 'c') ORDER BY conname",
+                (table_name,),
+            )
+            for position, (name, definition) in enumerate(cursor.fetchall()):
+                temporary = f"{shadow_table}_c{position}"
+                cursor.execute(f"ALTER TABLE {shadow_table} ADD CONSTRAINT {temporary} {definition}")
+                renames.append(f"ALTER TABLE {table_name} RENAME CONSTRAINT {temporary} TO {name}")
+            cursor.execute(
+                "SELECT quote_ident(c.relname), pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = to_regclass(%s) "
+                "AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid) ORDER BY c.relname",
+                (table_name,),
+            )
+            for position, (name, definition) in enumerate(cursor.fetchall()):
+                temporary = f"{shadow_table}_i{position}"
+                definition = re.sub(
+                    r"^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+",
+                    lambda match: f"{match.group(1)} {temporary} ON {shadow_table}",
+                    definition,
+                )
+                cursor.execute(definition)
+                renames.append(f"ALTER INDEX {temporary} RENAME TO {name}")
+
+            # Definitions that name the table itself are recreated once the shadow has its name
+            cursor.execute(
+                "SELECT conrelid::regclass::text, quote_ident(conname), pg_get_constraintdef(oid) "
+                "FROM pg_constraint WHERE contype = 'f' AND (conrelid = to_regclass(%s) OR confrelid = to_regclass(%s))",
+                (table_name, table_name),
+            )
+            foreign_keys = cursor.fetchall()
+            cursor.execute(
+                "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = to_regclass(%s) AND NOT tgisinternal",
+                (table_name,),
+            )
+            triggers = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                "SELECT a.privilege_type, CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE a.grantee::regrole::text END, "
+                "a.is_grantable FROM pg_class c, aclexplode(c.relacl) a WHERE c.oid = to_regclass(%s)",
+                (table_name,),
+            )
+            grants = cursor.fetchall()
+            cursor.execute(
+                "SELECT attname, attidentity <> '', pg_get_serial_sequence(%s, attname) FROM pg_attribute "
+                "WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped",
+                (table_name, table_name),
+            )
+            sequences = [row for row in cursor.fetchall() if row[2] is not None]
+
+            cursor.execute(f"LOCK TABLE {table_name} IN ACCESS EXCLUSIVE MODE")
+            for column, identity, sequence in sequences:
+                if identity:
+                    # The shadow has its own identity sequence, it continues where the table's left off
+                    cursor.execute(
+                        f"SELECT setval(pg_get_serial_sequence(%s, %s), last_value, is_called) FROM {sequence}",
+                        (shadow_table, column),
+                    )
+                else:
+                    # A serial sequence is owned by its column and would be dropped with the table
+                    cursor.execute(
+                        f"ALTER SEQUENCE {sequence} OWNED BY {shadow_table}.{psycopg2.extensions.quote_ident(column, cursor)}"
+                    )
+            for owner, name, _ in foreign_keys:
+                cursor.execute(f"ALTER TABLE {owner} DROP CONSTRAINT {name}")
+            cursor.execute(f"DROP TABLE {table_name}")
+            cursor.execute(f"ALTER TABLE {shadow_table} RENAME TO {table_name}")
+            for rename in renames:
+                cursor.execute(rename)
+            # Referencing rows are masked by their own tables later on, so the foreign keys are not
+            # checked against the masked keys here, VALIDATE CONSTRAINT checks them afterwards
+            for owner, name, definition in foreign_keys:
+                cursor.execute(f"ALTER TABLE {owner} ADD CONSTRAINT {name} {definition} NOT VALID")
+            for trigger in triggers:
+                cursor.execute(trigger)
+            for privilege, grantee, grantable in grants:
+                cursor.execute(
+                    f"GRANT {privilege} ON {table_name} TO {grantee}{' WITH GRANT OPTION' if grantable else ''}"
+                )
+            connection.commit()
+            cursor.execute(f"ANALYZE {table_name}")
+            connection.commit()
+            logging.info(
+                f"Swapped Postgres shadow table into {table_name}, rebuilt {len(renames)} indexes and "
+                f"constraints, {len(foreign_keys)} foreign keys and {len(triggers)} triggers"
+            )
+            return True
+        except psycopg2.Error as e:
+            if connection:
+                connection.rollback()
+            logging.error(f"Postgres shadow table swap failed: {str(e)}")
+            raise
         finally:
             if connection:
                 self.pool.putconn(connection)
@@ -201,45 +896,267 @@ class PostgresClient(AbstractDatabaseClient):
                 self.pool.putconn(connection)
                 logging.debug("Released Postgres connection back to pool")
 
-    def bulk_insert(self, schema: str, table_name: str, batch: List[Dict[str, Any]], primary_key: List[str]) -> None:
+    def estimate_row_count(self, table_name: str) -> Optional[int]:
+        # reltuples is kept by VACUUM and ANALYZE, it is -1 (0 before Postgres 14) until then
+        batch = self.fetch_first_batch(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", 1, (table_name,)
+        )
+        if batch and batch.rows[0][0] is not None and batch.rows[0][0] > 0:
+            return batch.rows[0][0]
+        # A 1% block sample instead of a full scan, small tables can sample to zero and are counted
+        batch = self.fetch_first_batch(
+            f"SELECT COUNT(*) * 100 FROM {table_name} TABLESAMPLE SYSTEM (1)", 1
+        )
+        if batch and batch.rows[0][0]:
+            return batch.rows[0][0]
+        return super().estimate_row_count(table_name)
+
+    def get_referenced_tables(self, table_name: str) -> List[str]:
+        batch = self.fetch_first_batch(
+            "SELECT DISTINCT confrelid::regclass::text FROM pg_constraint "
+            "WHERE contype = 'f' AND conrelid = to_regclass(%s)",
+            1000,
+            (table_name,),
+        )
+        # regclass text is schema qualified only for tables outside the search_path
+        return sorted({row[0].split(".")[-1] for row in batch.rows}) if batch else []
+
+    def get_key_sample_query(self, table_name: str, key_column: str, sample_rows: int) -> str:
+        # Randomly chosen whole blocks holding about sample_rows rows, read without a full scan
+        estimated_rows = self.estimate_row_count(table_name)
+        if not estimated_rows or estimated_rows <= sample_rows:
+            return super().get_key_sample_query(table_name, key_column, sample_rows)
+        percent = 100.0 * sample_rows / estimated_rows
+        return f"SELECT {key_column} AS scan_key FROM {table_name} TABLESAMPLE SYSTEM ({percent:.8f})"
+
+    def bulk_insert(
+        self,
+        schema: str,
+        table_name: str,
+        batch: RecordBatch,
+        primary_key: List[str],
+        delete_keys: Optional[List[Tuple[Any, ...]]] = None,
+        guard: WriteGuard = None,
+    ) -> None:
+        if not batch:
+            return
         connection = None
         try:
             connection = self.get_connection()
             cursor = connection.cursor()
+            self.check_guard(cursor, guard)
             # Delete existing rows based on primary key before inserting
-            for row in batch:
-                delete_query = f"DELETE FROM {table_name} WHERE {' AND '.join([f'{pk} = %s' for pk in primary_key])}"
-                logging.debug("Executing delete query for bulk insert: %s", delete_query)
-                cursor.execute(delete_query, tuple(row[pk] for pk in primary_key))
+            delete_query = f"DELETE FROM {table_name} WHERE {' AND '.join([f'{pk} = %s' for pk in primary_key])}"
+            logging.debug("Executing delete query for bulk insert: %s", delete_query)
+            cursor.executemany(delete_query, delete_keys if delete_keys is not None else batch.keys(primary_key))
             # Insert new rows
             insert_query = (
-                f"INSERT INTO {table_name} ({', '.join(batch[0].keys())}) VALUES ({', '.join(['%s'] * len(batch[0]))})"
+                f"INSERT INTO {table_name} ({', '.join(batch.columns)}) VALUES ({', '.join(['%s'] * len(batch.columns))})"
             )
             logging.debug("Executing bulk insert query: %s", insert_query)
-            cursor.executemany(insert_query, [tuple(row.values()) for row in batch])
+            cursor.executemany(insert_query, batch.rows)
             connection.commit()
             logging.info(f"Bulk inserted rows into Postgres table {table_name}")
-        except psycopg2.Error as e:
+        except (psycopg2.Error, WriteGuardError) as e:
+            if connection:
+                connection.rollback()
             logging.error(f"Postgres bulk insert failed: {str(e)}")
+            raise
         finally:
             if connection:
                 self.pool.putconn(connection)
                 logging.debug("Released Postgres connection back to pool")
 
-    def bulk_update(self, schema: str, table_name: str, batch: List[Dict[str, Any]], primary_key: List[str]) -> None:
+    def bulk_update(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
+        if not batch:
+            return
+        if self.update_mode == "row":
+            self.bulk_update_rowwise(schema, table_name, batch, primary_key, guard)
+            return
         connection = None
         try:
             connection = self.get_connection()
             cursor = connection.cursor()
-            for row in batch:
-                update_query = f"UPDATE {table_name} SET {', '.join([f'{key} = %s' for key in row.keys() if key not in primary_key])} WHERE {' AND '.join([f'{pk} = %s' for pk in primary_key])}"
-                params = [value for key, value in row.items() if key not in primary_key] + [row[pk] for pk in primary_key]
-                logging.debug("Executing update query: %s with params: %s", update_query, params)
-                cursor.execute(update_query, params)
+            self.check_guard(cursor, guard)
+            columns = list(batch.columns)
+            staging_table = f"staging_{table_name}"
+            # CREATE ... AS keeps column types but not NOT NULL constraints or indexes
+            cursor.execute(
+                f"CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS SELECT {', '.join(columns)} FROM {table_name} WITH NO DATA"
+            )
+            execute_values(
+                cursor,
+                f"INSERT INTO {staging_table} ({', '.join(columns)}) VALUES %s",
+                batch.rows,
+            )
+            update_query = (
+                f"UPDATE {table_name} SET {', '.join([f'{key} = {staging_table}.{key}' for key in columns if key not in primary_key])} "
+                f"FROM {staging_table} WHERE {' AND '.join([f'{table_name}.{pk} = {staging_table}.{pk}' for pk in primary_key])}"
+            )
+            logging.debug("Executing set-based update query: %s", update_query)
+            cursor.execute(update_query)
             connection.commit()
             logging.info(f"Bulk updated rows in Postgres table {table_name}")
-        except psycopg2.Error as e:
+        except (psycopg2.Error, WriteGuardError) as e:
+            if connection:
+                connection.rollback()
+            logging.error(f"Postgres bulk update failed: {str(e)}")
+            raise
+        finally:
+            if connection:
+                self.pool.putconn(connection)
+                logging.debug("Released Postgres connection back to pool")
+
+    def bulk_update_rowwise(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
+        connection = None
+        try:
+            connection = self.get_connection()
+            cursor = connection.cursor()
+            self.check_guard(cursor, guard)
+            value_columns = [key for key in batch.columns if key not in primary_key]
+            update_query = f"UPDATE {table_name} SET {', '.join([f'{key} = %s' for key in value_columns])} WHERE {' AND '.join([f'{pk} = %s' for pk in primary_key])}"
+            positions = [batch.column_index[key] for key in value_columns + list(primary_key)]
+            logging.debug("Executing update query: %s", update_query)
+            cursor.executemany(update_query, [tuple(row[position] for position in positions) for row in batch.rows])
+            connection.commit()
+            logging.info(f"Bulk updated rows in Postgres table {table_name}")
+        except (psycopg2.Error, WriteGuardError) as e:
+            if connection:
+                connection.rollback()
             logging.error(f"Postgres bulk update failed: {str(e)}")
+            raise
+        finally:
+            if connection:
+                self.pool.putconn(connection)
+                logging.debug("Released Postgres connection back to pool")
+
+    @staticmethod
+    def format_copy_text(value: Any, column_type: Optional[str] = None) -> str:
+        # Text form of a value as the column's input function reads it
+        if column_type == "json":
+            return json.dumps(value, default=str)
+        if column_type == "array" and isinstance(value, (list, tuple)):
+            return PostgresClient.format_array_literal(value)
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return "\\x" + bytes(value).hex()
+        return str(value)
+
+    @staticmethod
+    def format_array_literal(values: Sequence[Any]) -> str:
+        # Every element is quoted, so commas, braces and blanks in it are kept as they are
+        elements = []
+        for value in values:
+            if value is None:
+                elements.append("NULL")
+            elif isinstance(value, (list, tuple)):
+                elements.append(PostgresClient.format_array_literal(value))
+            else:
+                column_type = "json" if isinstance(value, dict) else None
+                text = PostgresClient.format_copy_text(value, column_type)
+                elements.append('"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"')
+        return "{" + ",".join(elements) + "}"
+
+    @staticmethod
+    def format_copy_value(value: Any, column_type: Optional[str] = None) -> str:
+        # In COPY csv format an unquoted empty field is NULL and any quoted field is a value
+        if value is None:
+            return ""
+        return '"' + PostgresClient.format_copy_text(value, column_type).replace('"', '""') + '"'
+
+    @staticmethod
+    def build_copy_buffer(
+        batch: RecordBatch, column_types: Optional[List[Optional[str]]] = None
+    ) -> io.StringIO:
+        column_types = column_types or [None] * len(batch.columns)
+        buffer = io.StringIO()
+        for row in batch.rows:
+            buffer.write(
+                ",".join(
+                    PostgresClient.format_copy_value(value, column_type)
+                    for value, column_type in zip(row, column_types)
+                )
+            )
+            buffer.write("\n")
+        buffer.seek(0)
+        return buffer
+
+    def get_copy_column_types(self, cursor, table_name: str, columns: List[str]) -> List[Optional[str]]:
+        # array or json for the columns whose text form differs from str() of the driver's value
+        if table_name not in self.copy_column_types:
+            cursor.execute(
+                "SELECT a.attname, CASE WHEN t.typcategory = 'A' THEN 'array' "
+                "WHEN t.typname IN ('json', 'jsonb') THEN 'json' END FROM pg_attribute a "
+                "JOIN pg_type t ON t.oid = a.atttypid "
+                "WHERE a.attrelid = to_regclass(%s) AND a.attnum > 0 AND NOT a.attisdropped",
+                (table_name,),
+            )
+            self.copy_column_types[table_name] = dict(cursor.fetchall())
+        column_types = self.copy_column_types[table_name]
+        return [column_types.get(column) for column in columns]
+
+    def copy_into(self, cursor, table_name: str, columns: List[str], batch: RecordBatch) -> None:
+        copy_query = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        column_types = self.get_copy_column_types(cursor, table_name, columns)
+        logging.debug("Executing copy query: %s", copy_query)
+        cursor.copy_expert(copy_query, self.build_copy_buffer(batch, column_types))
+
+    def bulk_load(self, schema: str, table_name: str, batch: RecordBatch, guard: WriteGuard = None) -> None:
+        if not batch:
+            return
+        connection = None
+        try:
+            connection = self.get_connection()
+            cursor = connection.cursor()
+            self.check_guard(cursor, guard)
+            self.copy_into(cursor, table_name, list(batch.columns), batch)
+            connection.commit()
+            logging.info(f"Copied rows into Postgres table {table_name}")
+        except (psycopg2.Error, WriteGuardError) as e:
+            if connection:
+                connection.rollback()
+            logging.error(f"Postgres copy load failed: {str(e)}")
+            raise
+        finally:
+            if connection:
+                self.pool.putconn(connection)
+                logging.debug("Released Postgres connection back to pool")
+
+    def bulk_update_or_insert(
+        self, schema: str, table_name: str, batch: RecordBatch, primary_key: List[str], guard: WriteGuard = None
+    ) -> None:
+        if not batch:
+            return
+        connection = None
+        try:
+            connection = self.get_connection()
+            cursor = connection.cursor()
+            self.check_guard(cursor, guard)
+            columns = list(batch.columns)
+            staging_table = f"staging_{table_name}"
+            cursor.execute(
+                f"CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS SELECT {', '.join(columns)} FROM {table_name} WITH NO DATA"
+            )
+            self.copy_into(cursor, staging_table, columns, batch)
+            merge_query = (
+                f"INSERT INTO {table_name} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {staging_table} "
+                f"ON CONFLICT ({', '.join(primary_key)}) DO UPDATE SET "
+                f"{', '.join([f'{key} = EXCLUDED.{key}' for key in columns if key not in primary_key])}"
+            )
+            logging.debug("Executing merge query: %s", merge_query)
+            cursor.execute(merge_query)
+            connection.commit()
+            logging.info(f"Copied and merged rows into Postgres table {table_name}")
+        except (psycopg2.Error, WriteGuardError) as e:
+            if connection:
+                connection.rollback()
+            logging.error(f"Postgres copy merge failed: {str(e)}")
+            raise
         finally:
             if connection:
                 self.pool.putconn(connection)
@@ -1,20 +1,59 @@
 #from db.db_clients import OracleClient, SQLServerClient, PostgresClient, SQLiteClient
+from db.client_registry import ClientRegistry
 from db.db_clients import PostgresClient, SQLiteClient
+from db.file_sink import FileSink
 
 class DBFactory:
+    client_registry = ClientRegistry()
+
     @staticmethod
-    def get_database_client(db_config, db_type, db_name):
+    def get_client_class(db_config, db_type, db_name):
         config = db_config.get(db_type, {}).get(db_name)
         if not config:
             raise ValueError(f"Unsupported or missing configuration for database type: {db_name}")
 
         if db_name == "sqlite":
-            return SQLiteClient(config)
+            return SQLiteClient
         elif db_name == "postgres":
-            return PostgresClient(config)
+            return PostgresClient
+        elif db_name == "file" and db_type == "target":
+            return FileSink
         # elif db_name == "sqlserver":
-        #     return SQLServerClient(config)
+        #     return SQLServerClient
         # elif db_name == "oracle":
-        #     return OracleClient(config)
+        #     return OracleClient
         else:
             raise ValueError(f"Unsupported database type: {db_name}")
+
+    @staticmethod
+    def get_database_client(db_config, db_type, db_name):
+        client_class = DBFactory.get_client_class(db_config, db_type, db_name)
+        return client_class(db_config[db_type][db_name])
+
+    @staticmethod
+    def get_pool_config(db_config, db_type, db_name):
+        config = db_config[db_type][db_name]
+        concurrency_limit = int(config.get("concurrency_limit", db_config.get("concurrency_limit", 3)))
+        # A masked key range fetches and writes at the same time, so each slot may use two connections
+        return dict(config, max_connections=int(config.get("max_connections", 2 * concurrency_limit)))
+
+    @staticmethod
+    def get_shared_client(db_config, db_type, db_name):
+        """The process-wide client of the database, callers leave it open for the other tables."""
+        client_class = DBFactory.get_client_class(db_config, db_type, db_name)
+        config = DBFactory.get_pool_config(db_config, db_type, db_name)
+
+        def create():
+            client = client_class(config)
+            client.pool_name = f"{db_type}.{db_name}"
+            return client
+
+        return DBFactory.client_registry.get_or_create((db_type, db_name), config, create)
+
+    @staticmethod
+    def close_shared_clients():
+        DBFactory.client_registry.close_all()
+
+    @staticmethod
+    def get_pool_stats():
+        return DBFactory.client_registry.stats()
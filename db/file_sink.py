@@ -0,0 +1,232 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from db.db_clients import BlockingIOClient
+from db.record_batch import RecordBatch
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet extracts are optional, csv and jsonl need only the standard library
+    pyarrow = None
+
+FILE_EXTENSIONS = {"csv": ".csv", "jsonl": ".jsonl", "parquet": ".parquet"}
+
+
+class CsvWriter:
+    def __init__(self, stream: Any, columns: Tuple[str, ...]):
+        self.writer = csv.writer(stream)
+        self.writer.writerow(columns)
+
+    def write(self, batch: RecordBatch) -> None:
+        # NULL is written as an empty field
+        self.writer.writerows(batch.rows)
+
+
+class JsonLinesWriter:
+    def __init__(self, stream: Any, columns: Tuple[str, ...]):
+        self.stream = stream
+        self.columns = columns
+
+    def write(self, batch: RecordBatch) -> None:
+        self.stream.writelines(
+            json.dumps(dict(zip(self.columns, row)), default=str) + "\n" for row in batch.rows
+        )
+
+
+class ParquetWriter:
+    def __init__(self, path: str, columns: Tuple[str, ...], compression: str):
+        self.path = path
+        self.columns = columns
+        self.compression = compression
+        self.writer = None
+        self.schema = None
+
+    def write(self, batch: RecordBatch) -> None:
+        arrays = list(zip(*batch.rows))
+        if self.writer is None:
+            # Typed from the first batch, a column that is all NULL there is kept as text
+            inferred = pyarrow.table(dict(zip(self.columns, arrays))).schema
+            self.schema = pyarrow.schema(
+                [
+                    (
+                        field.with_type(pyarrow.string())
+                        if pyarrow.types.is_null(field.type)
+                        else field
+                    )
+                    for field in inferred
+                ]
+            )
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.path,
+                self.schema,
+                compression=None if self.compression == "none" else self.compression,
+            )
+        # Each batch becomes one row group, so memory stays bounded by the batch size
+        self.writer.write_table(
+            pyarrow.table(
+                [
+                    pyarrow.array(values, type=field.type)
+                    for values, field in zip(arrays, self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ExtractFile:
+    def __init__(self, path: str, columns: Tuple[str, ...], file_format: str, compression: str):
+        self.path = path
+        # Written under a temporary name, a file only gets its final name once its range succeeded
+        self.partial_path = f"{path}.partial"
+        self.columns = columns
+        self.rows = 0
+        self.stream = None
+        if file_format == "parquet":
+            self.writer = ParquetWriter(self.partial_path, columns, compression)
+            return
+        if compression == "gzip":
+            self.stream = gzip.open(self.partial_path, "wt", newline="", encoding="utf-8")
+        else:
+            self.stream = open(self.partial_path, "w", newline="", encoding="utf-8")
+        writer_class = CsvWriter if file_format == "csv" else JsonLinesWriter
+        self.writer = writer_class(self.stream, columns)
+
+    def write(self, batch: RecordBatch) -> None:
+        self.writer.write(batch)
+        self.rows += len(batch)
+
+    def close(self) -> None:
+        if self.stream is not None:
+            self.stream.close()
+        else:
+            self.writer.close()
+
+    def commit(self) -> None:
+        os.replace(self.partial_path, self.path)
+        logging.info(f"Closed extract file {self.path} with {self.rows} rows")
+
+    def discard(self) -> None:
+        try:
+            self.close()
+        finally:
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+        logging.warning(f"Discarded extract file {self.path} with {self.rows} rows")
+
+
+class FileSink(BlockingIOClient):
+    """extract_mask_load target that appends masked batches to extract files instead of loading
+    them into a database, one directory per table."""
+
+    ROWID_COLUMN: Optional[str] = None
+
+    def __init__(self, config: Dict[str, Any]):
+        super().__init__()
+        self.config = config
+        # Relative paths resolve like the SQLite database_path
+        self.directory = os.path.expandvars(config.get("directory", "../extracts"))
+        if not os.path.isabs(self.directory):
+            self.directory = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), self.directory
+            )
+        self.file_format = config.get("format", "csv").lower()
+        if self.file_format not in FILE_EXTENSIONS:
+            raise ValueError(
+                f"Unsupported extract format {self.file_format}, "
+                f"expected one of {tuple(FILE_EXTENSIONS)}"
+            )
+        if self.file_format == "parquet" and pyarrow is None:
+            raise ValueError("Parquet extracts need pyarrow, install it or use csv or jsonl")
+        default_compression = "snappy" if self.file_format == "parquet" else "gzip"
+        self.compression = str(config.get("compression", default_compression)).lower()
+        if self.file_format != "parquet" and self.compression not in ("gzip", "none"):
+            raise ValueError(f"Unsupported compression {self.compression} for {self.file_format}")
+        # A new file starts once the current one holds this many rows, 0 keeps one file per sink
+        self.rows_per_file = int(config.get("rows_per_file", 0))
+        # Every sink writes its own files, so concurrent key ranges and reruns never share one
+        self.sink_id = uuid.uuid4().hex[:8]
+        self.file_count = 0
+        self.files: Dict[str, ExtractFile] = {}
+        # Files that are full but keep their temporary name until the sink is closed
+        self.closed_files: List[ExtractFile] = []
+
+    def get_path(self, table_name: str) -> str:
+        self.file_count += 1
+        extension = FILE_EXTENSIONS[self.file_format]
+        if self.file_format != "parquet" and self.compression == "gzip":
+            extension += ".gz"
+        table_directory = os.path.join(self.directory, table_name)
+        os.makedirs(table_directory, exist_ok=True)
+        return os.path.join(
+            table_directory, f"part-{self.sink_id}-{self.file_count:05d}{extension}"
+        )
+
+    def clear_table(self, table_name: str) -> int:
+        """Delete the part files earlier runs left for the table, returns how many there were."""
+        table_directory = os.path.join(self.directory, table_name)
+        if not os.path.isdir(table_directory):
+            return 0
+        names = [name for name in os.listdir(table_directory) if name.startswith("part-")]
+        for name in names:
+            os.remove(os.path.join(table_directory, name))
+        return len(names)
+
+    def bulk_load(
+        self, schema: str, table_name: str, batch: RecordBatch, guard: Any = None
+    ) -> None:
+        if guard is not None:
+            raise ValueError("Extract files have no transaction to run a write guard in")
+        if not batch:
+            return
+        extract_file = self.files.get(table_name)
+        if extract_file is not None and (
+            extract_file.columns != batch.columns
+            or (self.rows_per_file and extract_file.rows >= self.rows_per_file)
+        ):
+            extract_file.close()
+            self.closed_files.append(extract_file)
+            extract_file = None
+        if extract_file is None:
+            extract_file = ExtractFile(
+                self.get_path(table_name), batch.columns, self.file_format, self.compression
+            )
+            self.files[table_name] = extract_file
+        extract_file.write(batch)
+
+    def bulk_update_or_insert(
+        self,
+        schema: str,
+        table_name: str,
+        batch: RecordBatch,
+        primary_key: List[str],
+        guard: Any = None,
+    ) -> None:
+        # Extracted rows are unique by key already, a file has nothing to merge them with
+        self.bulk_load(schema, table_name, batch, guard)
+
+    def close(self) -> None:
+        super().close()
+        extract_files = self.closed_files + list(self.files.values())
+        self.closed_files, self.files = [], {}
+        for extract_file in extract_files:
+            extract_file.close()
+        for extract_file in extract_files:
+            extract_file.commit()
+
+    def abort(self) -> None:
+        """Delete every file this sink wrote, for a range that failed and will be read again."""
+        super().close()
+        extract_files = self.closed_files + list(self.files.values())
+        self.closed_files, self.files = [], {}
+        for extract_file in extract_files:
+            extract_file.discard()
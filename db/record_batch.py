@@ -0,0 +1,55 @@
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+class RecordBatch:
+    """Rows of one result set, column names stored once and each row kept as the driver's tuple."""
+
+    __slots__ = ("columns", "rows", "column_index")
+
+    def __init__(self, columns: Sequence[str], rows: Optional[List[Tuple[Any, ...]]] = None):
+        self.columns: Tuple[str, ...] = tuple(columns)
+        self.rows: List[Tuple[Any, ...]] = rows if rows is not None else []
+        self.column_index: Dict[str, int] = {
+            name: position for position, name in enumerate(self.columns)
+        }
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __bool__(self) -> bool:
+        return bool(self.rows)
+
+    def __iter__(self) -> Iterator[Tuple[Any, ...]]:
+        return iter(self.rows)
+
+    def column(self, name: str) -> List[Any]:
+        position = self.column_index[name]
+        return [row[position] for row in self.rows]
+
+    def keys(self, key_columns: Sequence[str]) -> List[Tuple[Any, ...]]:
+        positions = [self.column_index[name] for name in key_columns]
+        return [tuple(row[position] for position in positions) for row in self.rows]
+
+    def last_key(self, key_columns: Sequence[str]) -> Tuple[Any, ...]:
+        row = self.rows[-1]
+        return tuple(row[self.column_index[name]] for name in key_columns)
+
+    def with_columns(self, replacements: Dict[str, List[Any]]) -> "RecordBatch":
+        # Returns a new batch, the rows of this one are left untouched
+        if not replacements or not self.rows:
+            return self
+        arrays: List[Sequence[Any]] = list(zip(*self.rows))
+        for name, values in replacements.items():
+            arrays[self.column_index[name]] = values
+        return RecordBatch(self.columns, list(zip(*arrays)))
+
+    def drop_columns(self, names: Iterable[str]) -> "RecordBatch":
+        names = set(names)
+        positions = [position for position, name in enumerate(self.columns) if name not in names]
+        return RecordBatch(
+            [self.columns[position] for position in positions],
+            [tuple(row[position] for position in positions) for row in self.rows],
+        )
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        return [dict(zip(self.columns, row)) for row in self.rows]
@@ -0,0 +1,335 @@
+"""Dry run of the manifest, estimating how long a real masking run would take.
+
+Every table is sampled the way the run would read it and the real fetch, mask and write steps are
+timed on the sample. Masked rows are written to a scratch SQLite database, never to the configured
+target, SQLite sources and targets are opened read only, and the timings are extrapolated from the
+row count estimates. Run from the project root:
+
+    python -m main.dry_run --sample-rows 5000 --output estimate.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
+
+from db.db_factory import DBFactory
+from db.record_batch import RecordBatch
+from main.pii_data_masking_pipeline import (
+    get_pool_limits,
+    get_projected_columns,
+    get_scan_key,
+    get_scan_mode,
+    get_shadow_table,
+    get_table_plan,
+    get_table_pool,
+    iterate_batches,
+    load_all_configs,
+    mask_batch,
+    pii_manifest_path,
+    process_pii_manifest,
+    write_batch,
+)
+from masking.masking_executor import shutdown_process_executor
+from masking.masking_factory import MaskingFactory
+from masking.masking_plan import IN_PLACE_STRATEGIES, compile_manifest
+from utilities.table_scheduler import PoolKey
+from utilities.utilities import load_pii_manifest
+
+STAGES = ("fetch", "mask", "write")
+
+
+def create_scratch_table(
+    path: str,
+    table_name: str,
+    sample: RecordBatch,
+    key_columns: List[str],
+    rowid_column: Any,
+    preload: bool,
+) -> None:
+    # Untyped columns take any value, the sample is loaded first when the run updates in place
+    columns = [column for column in sample.columns if column != rowid_column]
+    definitions = list(columns)
+    if key_columns and key_columns != [rowid_column]:
+        definitions.append(f"PRIMARY KEY ({', '.join(key_columns)})")
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute(f"CREATE TABLE {table_name} ({', '.join(definitions)})")
+        if preload:
+            placeholders = ", ".join("?" for _ in sample.columns)
+            connection.executemany(
+                f"INSERT INTO {table_name} ({', '.join(sample.columns)}) VALUES ({placeholders})",
+                sample.rows,
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+async def sample_table(
+    table: Dict[str, Any],
+    db_config: Dict[str, Any],
+    metadata: Dict[str, Any],
+    sample_rows: int,
+    scratch_dir: str,
+) -> Dict[str, Any]:
+    table_name = table["table_name"]
+    masking_plan = get_table_plan(table, metadata)
+    pool = get_table_pool(table, metadata)
+    read_client = DBFactory.get_shared_client(db_config, *pool)
+    scratch_client = None
+    try:
+        estimated_rows = table.get("estimated_rows")
+        if estimated_rows is None:
+            estimated_rows = await read_client.run_blocking(
+                read_client.estimate_row_count, table_name
+            )
+        key_columns = await get_scan_key(read_client, table, metadata)
+        scan_mode = get_scan_mode(table, metadata, key_columns)
+        if masking_plan.strategy == "upsert" and masking_plan.projection:
+            projected_columns = get_projected_columns(masking_plan, key_columns)
+            if projected_columns:
+                table = dict(table, projected_columns=projected_columns)
+
+        # Read only, the extraction filter of an upsert is not applied to the target
+        batches: List[RecordBatch] = []
+        sampled_rows = 0
+        scan = iterate_batches(
+            read_client,
+            table,
+            table["schema"],
+            scan_mode,
+            key_columns,
+            min(masking_plan.batch_size, sample_rows),
+        )
+        start = time.perf_counter()
+        try:
+            async for batch, _ in scan:
+                if sampled_rows + len(batch) > sample_rows:
+                    batch = RecordBatch(batch.columns, batch.rows[: sample_rows - sampled_rows])
+                batches.append(batch)
+                sampled_rows += len(batch)
+                if sampled_rows >= sample_rows:
+                    break
+        finally:
+            await scan.aclose()
+        fetch_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        masked_batches = [await mask_batch(table, batch, metadata) for batch in batches]
+        mask_seconds = time.perf_counter() - start
+
+        write_seconds = 0.0
+        if batches:
+            scratch_path = os.path.join(scratch_dir, f"{uuid.uuid4().hex}.db")
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                create_scratch_table,
+                scratch_path,
+                get_shadow_table(table) if masking_plan.strategy == "rebuild" else table_name,
+                RecordBatch(batches[0].columns, [row for batch in batches for row in batch.rows]),
+                key_columns,
+                read_client.ROWID_COLUMN,
+                masking_plan.strategy == "upsert",
+            )
+            scratch_client = DBFactory.get_database_client(
+                {"target": {"sqlite": {"database_path": scratch_path}}}, "target", "sqlite"
+            )
+            start = time.perf_counter()
+            for batch, masked_batch in zip(batches, masked_batches):
+                if masking_plan.strategy in IN_PLACE_STRATEGIES:
+                    await write_batch(
+                        scratch_client, table, masked_batch, metadata, key_columns, None, batch
+                    )
+                else:
+                    await write_batch(
+                        read_client,
+                        table,
+                        masked_batch,
+                        metadata,
+                        key_columns,
+                        scratch_client,
+                        batch,
+                    )
+            write_seconds = time.perf_counter() - start
+    finally:
+        if scratch_client is not None:
+            scratch_client.close()
+
+    # A sample shorter than asked for is the whole table, so its size is known exactly
+    if sampled_rows < sample_rows:
+        estimated_rows = sampled_rows
+    estimated_rows = max(int(estimated_rows or 0), sampled_rows)
+    stage_seconds = {"fetch": fetch_seconds, "mask": mask_seconds, "write": write_seconds}
+    row_seconds = {
+        stage: seconds / sampled_rows if sampled_rows else 0.0
+        for stage, seconds in stage_seconds.items()
+    }
+    # With a pipeline the stages overlap and the slowest one sets the pace, otherwise they add up
+    if masking_plan.pipeline_depth > 0:
+        seconds_per_row = max(row_seconds.values())
+    else:
+        seconds_per_row = sum(row_seconds.values())
+    return {
+        "table": table_name,
+        "pool": {"role": pool[0], "database": pool[1]},
+        "strategy": masking_plan.strategy,
+        "masking_engine": masking_plan.masking_engine,
+        "scan_mode": scan_mode,
+        "key_columns": key_columns,
+        "sampled_rows": sampled_rows,
+        "estimated_rows": estimated_rows,
+        "stage_seconds": {stage: round(seconds, 6) for stage, seconds in stage_seconds.items()},
+        "rows_per_second": {
+            stage: round(1 / seconds, 1) if seconds else None
+            for stage, seconds in row_seconds.items()
+        },
+        "bottleneck": max(STAGES, key=lambda stage: row_seconds[stage]) if sampled_rows else None,
+        "estimated_seconds": round(estimated_rows * seconds_per_row, 3),
+    }
+
+
+def estimate_schedule(
+    results: List[Dict[str, Any]], pool_limits: Dict[PoolKey, int], default_limit: int
+) -> List[Dict[str, Any]]:
+    # Largest first onto the least loaded slot of each database, as the table scheduler runs them
+    slots: Dict[PoolKey, List[float]] = {}
+    tables: Dict[PoolKey, List[str]] = {}
+    for result in sorted(results, key=lambda result: result["estimated_seconds"], reverse=True):
+        pool = (result["pool"]["role"], result["pool"]["database"])
+        pool_slots = slots.setdefault(pool, [0.0] * max(pool_limits.get(pool, default_limit), 1))
+        slot = pool_slots.index(min(pool_slots))
+        pool_slots[slot] += result["estimated_seconds"]
+        tables.setdefault(pool, []).append(result["table"])
+    return [
+        {
+            "role": role,
+            "database": db_name,
+            "concurrency": len(pool_slots),
+            "tables": tables[(role, db_name)],
+            "estimated_seconds": round(max(pool_slots), 3),
+        }
+        for (role, db_name), pool_slots in slots.items()
+    ]
+
+
+def get_read_only_config(db_config: Dict[str, Any]) -> Dict[str, Any]:
+    # The tables are only read, SQLite files are opened read only and keep their journal mode
+    read_only_config = dict(db_config)
+    for role in ("source", "target"):
+        databases = db_config.get(role) or {}
+        if databases.get("sqlite"):
+            read_only_config[role] = dict(
+                databases, sqlite=dict(databases["sqlite"], read_only=True)
+            )
+    return read_only_config
+
+
+async def run_dry_run(args: argparse.Namespace) -> Tuple[Dict[str, Any], int]:
+    db_config, extraction_config = await load_all_configs()
+    db_config = get_read_only_config(db_config)
+    pii_manifest = load_pii_manifest(args.manifest)
+    pii_manifest = process_pii_manifest(pii_manifest, extraction_config)
+    plans = compile_manifest(pii_manifest)
+    metadata: Dict[str, Any] = pii_manifest["metadata"]
+    MaskingFactory.configure_cache(metadata.get("cipher_cache_size", 32))
+
+    results = []
+    errors = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as scratch_dir:
+        for table in pii_manifest["tables"]:
+            if args.tables and table["table_name"] not in args.tables:
+                continue
+            table = dict(table, masking_plan=plans[table["table_name"]])
+            try:
+                result = await sample_table(
+                    table, db_config, metadata, args.sample_rows, scratch_dir
+                )
+            except Exception as e:
+                logging.error(f"Dry run of {table['table_name']} failed: {str(e)}")
+                logging.error(f"Traceback: {traceback.format_exc()}")
+                errors.append(
+                    {"table": table["table_name"], "error": f"{type(e).__name__}: {str(e)}"}
+                )
+                continue
+            logging.info(
+                f"{result['table']}: {result['estimated_rows']} rows, "
+                f"about {result['estimated_seconds']}s"
+            )
+            results.append(result)
+
+    pools = estimate_schedule(
+        results, get_pool_limits(db_config), int(db_config.get("concurrency_limit", 3))
+    )
+    report = {
+        "dry_run": True,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "sample_rows": args.sample_rows,
+        "write_target": "scratch sqlite",
+        "tables": results,
+        "errors": errors,
+        "total": {
+            "tables": len(results),
+            "estimated_rows": sum(result["estimated_rows"] for result in results),
+            "sampled_rows": sum(result["sampled_rows"] for result in results),
+            # One table after another, and with every database working through its own tables
+            "sequential_seconds": round(sum(result["estimated_seconds"] for result in results), 3),
+            "estimated_seconds": max((pool["estimated_seconds"] for pool in pools), default=0.0),
+            "pools": pools,
+        },
+    }
+    return report, 1 if errors else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--manifest", default=pii_manifest_path, help="PII manifest to estimate")
+    parser.add_argument(
+        "--tables", type=lambda value: value.split(","), help="Comma separated subset of tables"
+    )
+    parser.add_argument("--sample-rows", type=int, default=1000, help="Rows sampled per table")
+    parser.add_argument(
+        "--workdir", help="Directory for the scratch databases, defaults to the system temp dir"
+    )
+    parser.add_argument("--output", help="Write the JSON estimate here instead of stdout")
+    args = parser.parse_args()
+    if args.sample_rows < 1:
+        parser.error("--sample-rows must be at least 1")
+    return args
+
+
+def main() -> int:
+    args = parse_args()
+    # Values the scratch SQLite database cannot bind otherwise, e.g. Postgres numerics
+    sqlite3.register_adapter(Decimal, str)
+    sqlite3.register_adapter(uuid.UUID, str)
+    try:
+        report, exit_code = asyncio.run(run_dry_run(args))
+    except Exception as e:
+        logging.error(f"Error in dry run: {str(e)}")
+        logging.error(f"Traceback: {traceback.format_exc()}")
+        report, exit_code = {"dry_run": True, "error": f"{type(e).__name__}: {str(e)}"}, 1
+    finally:
+        DBFactory.close_shared_clients()
+        shutdown_process_executor()
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
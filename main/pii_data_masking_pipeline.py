@@ -1,17 +1,32 @@
 import asyncio
 import logging
 import os
+import sys
+import time
 import traceback
 
 import yaml
-from typing import Any, Dict, List, Tuple
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from db.db_clients import WriteGuard
 from db.db_factory import DBFactory
+from db.file_sink import FileSink
+from db.record_batch import RecordBatch
 from utilities.utilities import (
     load_pii_manifest,
     replace_jinja_parameters,
 )
-from masking.masking_utils import apply_masking
+from masking.masking_utils import apply_masking, build_scalar_masker, get_memo_stats
 from masking.masking_factory import MaskingFactory
+from masking.masking_plan import (
+    IN_PLACE_STRATEGIES,
+    TablePlan,
+    compile_manifest,
+    compile_table_plan,
+)
+from masking.masking_executor import shutdown_process_executor
+from utilities.checkpoint_store import STATUS_DONE, CheckpointStore
+from utilities.metrics import MetricsExporter, get_metrics
+from utilities.table_scheduler import PoolKey, TableJob, TableScheduler
 
 # Set up base directory and logging
 base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -19,16 +34,25 @@ log_dir = os.path.join(base_dir, "..", "logs")
 os.makedirs(log_dir, exist_ok=True)
 logging.basicConfig(
     filename=os.path.join(log_dir, "masking.log"),
-    level=logging.DEBUG,
+    level=os.getenv("MASKING_LOG_LEVEL", "INFO").upper(),
     format="%(asctime)s - %(levelname)s - %(message)s",
 )
+# The ff3 library logs its tweak and round values for every value it encrypts
+logging.getLogger("ff3").setLevel(logging.WARNING)
 
 # Load configurations
 config_path: str = os.path.join(base_dir, "..", "config", "db_config.yaml")
 extraction_config_path: str = os.path.join(base_dir, "..", "config", "extraction_config.yaml")
 pii_manifest_path: str = os.path.join(base_dir, "..", "config", "pii_manifest.yaml")
 
-BATCH_SIZE = 10  # Define batch size for processing
+# Key range as (exclusive lower key, inclusive upper key), None leaves that end open
+KeyRange = Tuple[Optional[Tuple[Any, ...]], Optional[Tuple[Any, ...]]]
+FULL_KEY_RANGE: KeyRange = (None, None)
+# Extra SQL condition with its parameters, e.g. the watermark window of an incremental table
+RowFilter = Tuple[str, Tuple[Any, ...]]
+
+MASKING_FUNCTION_NAME = "fpe_mask"  # SQL function registered for in-database masking
+SHADOW_TABLE_SUFFIX = "_masking_shadow"  # A rebuild copies the masked rows into this table first
 
 
 async def load_config(file_path: str) -> Dict[str, Any]:
@@ -55,42 +79,598 @@ def process_pii_manifest(
     return pii_manifest
 
 
+def get_table_plan(table: Dict[str, Any], metadata: Dict[str, Any]) -> TablePlan:
+    # Compiled once in process_table and carried with the table, compiled here for direct callers
+    return table.get("masking_plan") or compile_table_plan(table, metadata)
+
+
+def rewrites_key(table: Dict[str, Any], metadata: Dict[str, Any], key_columns: List[str]) -> bool:
+    # An upsert of a masked key deletes each row and inserts it again under its masked key
+    plan = get_table_plan(table, metadata)
+    return plan.strategy == "upsert" and any(key in plan.pii_column_names for key in key_columns)
+
+
+def get_scan_mode(table: Dict[str, Any], metadata: Dict[str, Any], key_columns: List[str]) -> str:
+    scan_mode = get_table_plan(table, metadata).scan_mode
+    if scan_mode != "stream" and rewrites_key(table, metadata, key_columns):
+        # A keyset or offset scan would read rows again under their masked keys and mask them
+        # twice, one snapshot read sees every row exactly once
+        logging.warning(f"{table['table_name']} rewrites its masked key, using a stream scan")
+        return "stream"
+    if scan_mode == "keyset" and not key_columns:
+        logging.warning(f"{table['table_name']} has no usable key for a keyset scan, using offset")
+        scan_mode = "offset"
+    return scan_mode
+
+
+async def get_scan_key(
+    db_client: Any, table: Dict[str, Any], metadata: Dict[str, Any]
+) -> List[str]:
+    # Prefer the manifest primary key, then the declared key of the table, then the SQLite rowid
+    primary_key = list(get_table_plan(table, metadata).primary_key)
+    if not primary_key:
+        primary_key = await db_client.run_blocking(db_client.get_primary_key, table["table_name"])
+    if not primary_key and db_client.ROWID_COLUMN:
+        logging.info(f"{table['table_name']} has no primary key, scanning by {db_client.ROWID_COLUMN}")
+        primary_key = [db_client.ROWID_COLUMN]
+    return list(primary_key)
+
+
 async def fetch_batch(
     db_client: Any, table: Dict[str, Any], schema: str, offset: int, limit: int
-) -> List[Dict[str, Any]]:
+) -> RecordBatch:
     #query = f"SELECT * FROM {schema}.{table['table_name']} LIMIT {limit} OFFSET {offset}"
-    query = f"SELECT * FROM {table['table_name']} LIMIT {limit} OFFSET {offset}"
-    return await db_client.execute_query(query, BATCH_SIZE)
+    predicate, params = build_key_predicate(db_client, [], None, None, table.get("row_filter"))
+    query = (
+        f"SELECT {get_select_list(db_client, [], table)} FROM {table['table_name']}{predicate} "
+        f"LIMIT {limit} OFFSET {offset}"
+    )
+    return await db_client.execute_query(query, limit, params)
 
 
-async def process_batch(
-    db_client: Any, table: Dict[str, Any], batch: List[Dict[str, Any]], pii_metadata: Dict[str, Any]
+def get_shadow_table(table: Dict[str, Any]) -> str:
+    return f"{table['table_name']}{SHADOW_TABLE_SUFFIX}"
+
+
+def get_projected_columns(plan: TablePlan, key_columns: List[str]) -> Optional[List[str]]:
+    # Updates in place only need the key and the PII columns, everything else is left untouched
+    pii_columns = [column.column_name for column in plan.pii_columns]
+    if not key_columns or any(key in pii_columns for key in key_columns):
+        return None  # Masked keys are rewritten by delete and insert, which needs whole rows
+    return list(key_columns) + [column for column in pii_columns if column not in key_columns]
+
+
+def get_select_list(
+    db_client: Any, key_columns: List[str], table: Optional[Dict[str, Any]] = None
+) -> str:
+    projected_columns = table.get("projected_columns") if table else None
+    if projected_columns:
+        return ", ".join(
+            f"{column} AS {column}" if column == db_client.ROWID_COLUMN else column
+            for column in projected_columns
+        )
+    # The rowid is not part of SELECT *, so it is selected explicitly when it is the scan key
+    if key_columns and key_columns == [db_client.ROWID_COLUMN]:
+        return f"{db_client.ROWID_COLUMN} AS {db_client.ROWID_COLUMN}, *"
+    return "*"
+
+
+def build_key_predicate(
+    db_client: Any,
+    key_columns: List[str],
+    last_key: Optional[Tuple[Any, ...]],
+    upper_key: Optional[Tuple[Any, ...]] = None,
+    row_filter: Optional[RowFilter] = None,
+) -> Tuple[str, Tuple[Any, ...]]:
+    # Row-value comparison keeps composite keys in index order
+    key_list = ", ".join(key_columns)
+    placeholders = ", ".join([db_client.PLACEHOLDER] * len(key_columns))
+    clauses: List[str] = []
+    params: Tuple[Any, ...] = ()
+    if row_filter is not None:
+        clauses.append(f"({row_filter[0]})")
+        params += tuple(row_filter[1])
+    if last_key is not None:
+        clauses.append(f"({key_list}) > ({placeholders})")
+        params += tuple(last_key)
+    if upper_key is not None:
+        clauses.append(f"({key_list}) <= ({placeholders})")
+        params += tuple(upper_key)
+    return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+
+def stream_batches(
+    db_client: Any,
+    table: Dict[str, Any],
+    schema: str,
+    key_columns: List[str],
+    batch_size: int,
+    key_range: KeyRange = FULL_KEY_RANGE,
+) -> AsyncIterator[RecordBatch]:
+    predicate, params = build_key_predicate(
+        db_client, key_columns, *key_range, row_filter=table.get("row_filter")
+    )
+    select_list = get_select_list(db_client, key_columns, table)
+    query = f"SELECT {select_list} FROM {table['table_name']}{predicate}"
+    if key_columns:
+        query += f" ORDER BY {', '.join(key_columns)}"
+    return db_client.stream_query(query, batch_size, params)
+
+
+async def fetch_batch_keyset(
+    db_client: Any,
+    table: Dict[str, Any],
+    schema: str,
+    key_columns: List[str],
+    last_key: Optional[Tuple[Any, ...]],
+    limit: int,
+    upper_key: Optional[Tuple[Any, ...]] = None,
+) -> RecordBatch:
+    predicate, params = build_key_predicate(
+        db_client, key_columns, last_key, upper_key, table.get("row_filter")
+    )
+    query = (
+        f"SELECT {get_select_list(db_client, key_columns, table)} FROM {table['table_name']}"
+        f"{predicate} ORDER BY {', '.join(key_columns)} LIMIT {limit}"
+    )
+    return await db_client.execute_query(query, limit, params)
+
+
+async def plan_key_ranges(
+    db_client: Any, table: Dict[str, Any], key_columns: List[str], scan_mode: str
+) -> List[KeyRange]:
+    # Split a large table into contiguous key ranges that are masked as independent sub-tasks
+    partitions = int(table.get("partitions", 1))
+    if partitions <= 1 or scan_mode == "offset":
+        return [FULL_KEY_RANGE]
+    if len(key_columns) != 1:
+        logging.warning(f"{table['table_name']} has a composite key, it is not split into ranges")
+        return [FULL_KEY_RANGE]
+
+    if table.get("partition_method", "quantile") == "minmax":
+        # Cheap for integer keys, both ends come from the index, but skewed keys give uneven ranges
+        low, high = await db_client.run_blocking(
+            db_client.get_key_range, table["table_name"], key_columns[0]
+        )
+        if not isinstance(low, int) or not isinstance(high, int):
+            logging.warning(f"{table['table_name']} key is not an integer, using quantile split")
+            boundaries = await db_client.run_blocking(
+                db_client.get_key_quantiles, table["table_name"], key_columns[0], partitions
+            )
+        else:
+            step = (high - low) / partitions
+            boundaries = [low + int(step * index) for index in range(1, partitions)]
+    else:
+        boundaries = await db_client.run_blocking(
+            db_client.get_key_quantiles, table["table_name"], key_columns[0], partitions
+        )
+    boundaries = sorted(set(boundary for boundary in boundaries if boundary is not None))
+
+    # Lower bounds are exclusive and upper bounds inclusive, None leaves that end open
+    lower_keys = [None] + [(boundary,) for boundary in boundaries]
+    upper_keys = [(boundary,) for boundary in boundaries] + [None]
+    key_ranges = list(zip(lower_keys, upper_keys))
+    logging.info(f"{table['table_name']} split into {len(key_ranges)} key ranges")
+    return key_ranges
+
+
+def build_watermark_filter(
+    db_client: Any, table: Dict[str, Any], window: Tuple[Any, Any]
+) -> RowFilter:
+    # Rows changed after the stored watermark, up to the high-water mark taken when the run began
+    column = table["watermark"]["column"]
+    low, high = window
+    if low is None:
+        return f"{column} <= {db_client.PLACEHOLDER}", (high,)
+    return (
+        f"{column} > {db_client.PLACEHOLDER} AND {column} <= {db_client.PLACEHOLDER}",
+        (low, high),
+    )
+
+
+async def plan_watermark_window(
+    db_client: Any, table: Dict[str, Any], checkpoint_store: CheckpointStore
+) -> Tuple[Any, Any]:
+    table_name = table["table_name"]
+    low = checkpoint_store.get_watermark(table_name)
+    if low is None:
+        low = table["watermark"].get("initial")
+    _, high = await db_client.run_blocking(
+        db_client.get_key_range, table_name, table["watermark"]["column"]
+    )
+    checkpoint_store.start_watermark_window(table_name, high)
+    logging.info(f"{table_name} incremental window {table['watermark']['column']} ({low}, {high}]")
+    return low, high
+
+
+async def load_batch(
+    target_client: Any,
+    table: Dict[str, Any],
+    masked_batch: RecordBatch,
+    primary_key: List[str],
+    pii_metadata: Dict[str, Any],
+    source_rowid: Optional[str] = None,
+    guard: WriteGuard = None,
 ) -> None:
-    primary_key: List[str] = table.get("primary_key", [])
-    logging.debug(f"{table['table_name']} - primary key - {', '.join(primary_key)}")
-    pii_columns = [col["column_name"] for col in table["columns"] if col.get("pii") == "Y"]
+    load_mode = get_table_plan(table, pii_metadata).load_mode
+    # A rowid used as the scan key belongs to the source table, it is not loaded into the target
+    if source_rowid and primary_key == [source_rowid]:
+        masked_batch = masked_batch.drop_columns(primary_key)
+        primary_key = []
+    if load_mode == "merge" and primary_key:
+        await target_client.run_blocking(
+            target_client.bulk_update_or_insert,
+            table["schema"],
+            table["table_name"],
+            masked_batch,
+            primary_key,
+            guard,
+        )
+    else:
+        await target_client.run_blocking(
+            target_client.bulk_load, table["schema"], table["table_name"], masked_batch, guard
+        )
+
+
+async def mask_batch(
+    table: Dict[str, Any], batch: RecordBatch, pii_metadata: Dict[str, Any]
+) -> RecordBatch:
+    # Apply masking to the entire batch, the batch as read is kept for its original keys
+    with get_metrics().timer("batch_seconds", table=table["table_name"], stage="mask"):
+        masked_batch = await apply_masking(batch, get_table_plan(table, pii_metadata))
+    get_metrics().inc("rows_total", len(batch), table=table["table_name"], stage="mask")
+    return masked_batch
 
-    # Apply masking to the entire batch
-    masked_batch = await apply_masking(batch, table["columns"], pii_metadata)
 
+async def write_batch(
+    db_client: Any,
+    table: Dict[str, Any],
+    masked_batch: RecordBatch,
+    pii_metadata: Dict[str, Any],
+    primary_key: List[str],
+    target_client: Any = None,
+    source_batch: Optional[RecordBatch] = None,
+    guard: WriteGuard = None,
+) -> None:
+    logging.debug("%s - primary key - %s", table["table_name"], primary_key)
+    with get_metrics().timer("batch_seconds", table=table["table_name"], stage="write"):
+        await write_masked_batch(
+            db_client,
+            table,
+            masked_batch,
+            pii_metadata,
+            primary_key,
+            target_client,
+            source_batch,
+            guard,
+        )
+    get_metrics().inc("rows_total", len(masked_batch), table=table["table_name"], stage="write")
+
+
+async def write_masked_batch(
+    db_client: Any,
+    table: Dict[str, Any],
+    masked_batch: RecordBatch,
+    pii_metadata: Dict[str, Any],
+    primary_key: List[str],
+    target_client: Any = None,
+    source_batch: Optional[RecordBatch] = None,
+    guard: WriteGuard = None,
+) -> None:
+    plan = get_table_plan(table, pii_metadata)
+    pii_columns = plan.pii_column_names
+
+    # In extract_mask_load the masked batch goes to the target, the source is never written
+    if target_client is not None:
+        await load_batch(
+            target_client,
+            table,
+            masked_batch,
+            primary_key,
+            pii_metadata,
+            db_client.ROWID_COLUMN,
+            guard,
+        )
+    elif plan.strategy == "rebuild":
+        # Appended to the shadow table, the table being read is left as it is until the swap
+        await db_client.run_blocking(
+            db_client.bulk_load, table["schema"], get_shadow_table(table), masked_batch, guard
+        )
     # Decide upfront whether to insert or update based on primary key
-    if any(pk in pii_columns for pk in primary_key):
-        await db_client.bulk_insert(table["schema"], table["table_name"], masked_batch, primary_key)
+    elif any(pk in pii_columns for pk in primary_key):
+        # Masking rewrote the key, so the rows to replace are found by the keys as read
+        await db_client.run_blocking(
+            db_client.bulk_insert,
+            table["schema"],
+            table["table_name"],
+            masked_batch,
+            primary_key,
+            source_batch.keys(primary_key) if source_batch is not None else None,
+            guard,
+        )
     else:
-        await db_client.bulk_update(table["schema"], table["table_name"], masked_batch, primary_key)
+        await db_client.run_blocking(
+            db_client.bulk_update,
+            table["schema"],
+            table["table_name"],
+            masked_batch,
+            primary_key,
+            guard,
+        )
 
 
-async def process_table_in_batches(
-    db_client: Any, table: Dict[str, Any], pii_metadata: Dict[str, Any], schema: str
+async def process_batch(
+    db_client: Any,
+    table: Dict[str, Any],
+    batch: RecordBatch,
+    pii_metadata: Dict[str, Any],
+    primary_key: List[str],
+    target_client: Any = None,
 ) -> None:
-    offset = 0
+    masked_batch = await mask_batch(table, batch, pii_metadata)
+    await write_batch(
+        db_client, table, masked_batch, pii_metadata, primary_key, target_client, batch
+    )
+
+
+async def iterate_batches(
+    db_client: Any,
+    table: Dict[str, Any],
+    schema: str,
+    scan_mode: str,
+    key_columns: List[str],
+    batch_size: int,
+    key_range: KeyRange = FULL_KEY_RANGE,
+) -> AsyncIterator[Tuple[RecordBatch, Optional[Tuple[Any, ...]]]]:
+    # Yields each batch with its last key as read, masking may rewrite primary key values
+    if scan_mode == "keyset":
+        last_key, upper_key = key_range
+        while True:
+            batch = await fetch_batch_keyset(
+                db_client, table, schema, key_columns, last_key, batch_size, upper_key
+            )
+            if not batch:
+                break  # No more records to process
+
+            last_key = batch.last_key(key_columns)
+            yield batch, last_key
+    elif scan_mode == "offset":
+        offset = 0
+        while True:
+            batch = await fetch_batch(db_client, table, schema, offset, batch_size)
+            if not batch:
+                break  # No more records to process
+
+            yield batch, None
+            offset += batch_size  # Move to the next batch
+    elif scan_mode == "stream":
+        # One long-lived query, read through a server-side cursor where the driver supports it
+        async for batch in stream_batches(
+            db_client, table, schema, key_columns, batch_size, key_range
+        ):
+            yield batch, batch.last_key(key_columns) if key_columns else None
+    else:
+        raise ValueError(f"Unsupported scan mode: {scan_mode}")
+
+
+async def instrument_batches(
+    batches: AsyncIterator[Tuple[RecordBatch, Any]], table_name: str
+) -> AsyncIterator[Tuple[RecordBatch, Any]]:
+    # Times each fetch separately from the consumer's work on the batch before it
+    batches = batches.__aiter__()
     while True:
-        batch = await fetch_batch(db_client, table, schema, offset, BATCH_SIZE)
-        if not batch:
-            break  # No more records to process
+        start = time.perf_counter()
+        try:
+            batch, batch_key = await batches.__anext__()
+        except StopAsyncIteration:
+            break
+        get_metrics().observe(
+            "batch_seconds", time.perf_counter() - start, table=table_name, stage="fetch"
+        )
+        get_metrics().inc("rows_total", len(batch), table=table_name, stage="fetch")
+        yield batch, batch_key
+
+
+async def run_uninterrupted(awaitable: Awaitable[Any]) -> Any:
+    # Runs the awaitable to its end, a cancellation of the caller is raised only after it returns
+    task = asyncio.ensure_future(awaitable)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError()
+    return task.result()
+
+
+async def run_together(awaitables: List[Awaitable[Any]]) -> None:
+    # Like gather, but the first failure cancels the others and waits for them before it is raised,
+    # so no task is left writing once its caller has stopped
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_batch_pipeline(
+    batches: AsyncIterator[Tuple[RecordBatch, Any]],
+    mask: Callable[[RecordBatch], Awaitable[RecordBatch]],
+    write: Callable[[RecordBatch, RecordBatch, Any], Awaitable[None]],
+    depth: int,
+) -> None:
+    # fetch -> mask -> write connected by bounded queues, a full queue pauses the stage feeding it
+    fetched: asyncio.Queue = asyncio.Queue(maxsize=depth)
+    masked: asyncio.Queue = asyncio.Queue(maxsize=depth)
+
+    async def fetch_stage() -> None:
+        async for item in batches:
+            await fetched.put(item)
+        await fetched.put(None)
+
+    async def mask_stage() -> None:
+        while True:
+            item = await fetched.get()
+            if item is None:
+                break
+            batch, batch_key = item
+            await masked.put((batch, await mask(batch), batch_key))
+        await masked.put(None)
 
-        await process_batch(db_client, table, batch, pii_metadata)
-        offset += BATCH_SIZE  # Move to the next batch
+    async def write_stage() -> None:
+        while True:
+            item = await masked.get()
+            if item is None:
+                break
+            await write(*item)
+
+    # A failed stage would leave its neighbours blocked on a queue, so it stops them all
+    await run_together([fetch_stage(), mask_stage(), write_stage()])
+
+
+async def process_table_in_batches(
+    db_client: Any,
+    table: Dict[str, Any],
+    pii_metadata: Dict[str, Any],
+    schema: str,
+    target_client: Any = None,
+    key_columns: Optional[List[str]] = None,
+    key_range: KeyRange = FULL_KEY_RANGE,
+    checkpoint_store: Optional[CheckpointStore] = None,
+) -> None:
+    plan = get_table_plan(table, pii_metadata)
+    batch_size = plan.batch_size
+    depth = plan.pipeline_depth
+    if key_columns is None:
+        key_columns = await get_scan_key(db_client, table, pii_metadata)
+    scan_mode = get_scan_mode(table, pii_metadata, key_columns)
+
+    # Resume after the last committed key of this range, or skip it if it already finished
+    scan_range = key_range
+    rows_processed = 0
+    if checkpoint_store is not None:
+        checkpoint = checkpoint_store.get_checkpoint(table["table_name"], key_range)
+        if checkpoint is not None:
+            if checkpoint["status"] == STATUS_DONE:
+                logging.info(f"{table['table_name']} range {key_range} already done, skipping")
+                return
+            rows_processed = checkpoint["rows_processed"]
+            if rows_processed and rewrites_key(table, pii_metadata, key_columns):
+                # Masked keys after the last saved key would be read and masked a second time
+                raise ValueError(
+                    f"{table['table_name']} range {key_range} was partly masked with its key "
+                    "rewritten in place and cannot be resumed, restore the table and run it again "
+                    "or use strategy rebuild"
+                )
+            if rows_processed and (checkpoint["last_key"] is None or scan_mode == "offset"):
+                # Offset and keyless scans would start from the first row again, over rows that
+                # were masked already
+                raise ValueError(
+                    f"{table['table_name']} range {key_range} was partly masked by a scan with no "
+                    "key to resume after, restore the target and start a new run or use "
+                    "scan_mode keyset"
+                )
+            if checkpoint["last_key"] is not None:
+                logging.info(f"Resuming {table['table_name']} after key {checkpoint['last_key']}")
+                scan_range = (checkpoint["last_key"], key_range[1])
+
+    async def write(
+        batch: RecordBatch, masked_batch: RecordBatch, batch_key: Optional[Tuple[Any, ...]]
+    ) -> None:
+        nonlocal rows_processed
+        guard = None
+        if checkpoint_store is not None and masked_batch:
+            # Progress the target can record in the batch's own transaction is saved there
+            guard = checkpoint_store.get_write_guard(
+                target_client if target_client is not None else db_client,
+                table["table_name"],
+                key_range,
+                batch_key,
+                rows_processed + len(masked_batch),
+            )
+
+        async def write_and_save() -> None:
+            await write_batch(
+                db_client,
+                table,
+                masked_batch,
+                pii_metadata,
+                key_columns,
+                target_client,
+                batch,
+                guard,
+            )
+            # Offset scans have no key to resume after, their row count marks the range as started
+            if checkpoint_store is not None and guard is None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    checkpoint_store.save_progress,
+                    table["table_name"],
+                    key_range,
+                    batch_key,
+                    rows_processed + len(masked_batch),
+                )
+
+        # The batch commits in an I/O thread whether or not its caller is cancelled, so the
+        # checkpoint after it must be saved too or a resumed run would mask the batch again
+        await run_uninterrupted(write_and_save())
+        rows_processed += len(masked_batch)
+
+    batches = instrument_batches(
+        iterate_batches(db_client, table, schema, scan_mode, key_columns, batch_size, scan_range),
+        table["table_name"],
+    )
+    if depth < 1:
+        async for batch, batch_key in batches:
+            await write(batch, await mask_batch(table, batch, pii_metadata), batch_key)
+    else:
+        await run_batch_pipeline(
+            batches, lambda batch: mask_batch(table, batch, pii_metadata), write, depth
+        )
+
+    if checkpoint_store is not None:
+        checkpoint_store.save_progress(
+            table["table_name"], key_range, None, rows_processed, STATUS_DONE
+        )
+
+
+async def plan_table(
+    table: Dict[str, Any],
+    db_config: Dict[str, Any],
+    metadata: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+    watermark_store: Optional[CheckpointStore] = None,
+) -> Tuple[List[str], List[KeyRange], Optional[Tuple[Any, Any]]]:
+    # Key columns, key ranges and, given a store to read the watermark from, the watermark window
+    mode = get_table_plan(table, metadata).strategy
+    # Rows are read from the target in upsert and rebuild, from the source in extract_mask_load
+    if mode in IN_PLACE_STRATEGIES:
+        read_role, read_db = "target", metadata["target_db"]
+    else:
+        read_role, read_db = "source", metadata.get("source_db")
+    window = None
+    async with semaphore:
+        planning_client = DBFactory.get_shared_client(db_config, read_role, read_db)
+        if mode in IN_PLACE_STRATEGIES and "extraction_logic" in table:
+            await planning_client.run_blocking(planning_client.delete_unwanted_data, table)
+        key_columns = await get_scan_key(planning_client, table, metadata)
+        scan_mode = get_scan_mode(table, metadata, key_columns)
+        if rewrites_key(table, metadata, key_columns):
+            # Rows moved by another range's masked keys could land in a range not yet read
+            key_ranges = [FULL_KEY_RANGE]
+        else:
+            key_ranges = await plan_key_ranges(planning_client, table, key_columns, scan_mode)
+        if watermark_store is not None:
+            window = await plan_watermark_window(planning_client, table, watermark_store)
+    return key_columns, key_ranges, window
 
 
 async def process_table(
@@ -98,68 +678,404 @@ async def process_table(
     db_config: Dict[str, Any],
     pii_manifest: Dict[str, Any],
     semaphore: asyncio.Semaphore,
+    checkpoint_store: Optional[CheckpointStore] = None,
 ) -> None:
-    async with semaphore:
-        mode: str = table.get("strategy", pii_manifest["metadata"].get("strategy", "upsert"))
-        target_db: str = pii_manifest["metadata"]["target_db"]
-        source_db: str = pii_manifest["metadata"].get("source_db")
+    metadata: Dict[str, Any] = pii_manifest["metadata"]
+    masking_plan = get_table_plan(table, metadata)
+    table = dict(table, masking_plan=masking_plan)
+    mode: str = masking_plan.strategy
+    target_db: str = metadata["target_db"]
+    source_db: str = metadata.get("source_db")
+
+    incremental = bool(table.get("watermark"))
+    if incremental and checkpoint_store is None:
+        logging.warning(f"{table['table_name']} declares a watermark but checkpoints are disabled")
+        incremental = False
+
+    # A resumed run reuses the stored plan, masking may have moved the keys it would recompute
+    plan = checkpoint_store.get_plan(table["table_name"]) if checkpoint_store else None
+    window = None
+    if plan is not None:
+        if checkpoint_store.is_table_done(table["table_name"]):
+            if mode == "rebuild":
+                # Every row was copied, the run may have stopped before the shadow was swapped in
+                await swap_shadow_table(table, db_config, metadata, semaphore)
+            logging.info(f"{table['table_name']} already masked in run {checkpoint_store.run_id}")
+            return
+        key_columns, key_ranges = plan
+        if incremental:
+            window = checkpoint_store.get_watermark_window(table["table_name"])
+    else:
+        key_columns, key_ranges, window = await plan_table(
+            table, db_config, metadata, semaphore, checkpoint_store if incremental else None
+        )
+        if checkpoint_store is not None:
+            checkpoint_store.save_plan(table["table_name"], key_columns, key_ranges)
+
+    if window is not None:
+        if window[1] is None:
+            logging.info(f"{table['table_name']} has no rows in its watermark column, nothing to do")
+            checkpoint_store.commit_watermark(table["table_name"])
+            return
+        # The filter goes with the table description, so every range and scan mode applies it
+        read_client_class = DBFactory.get_client_class(
+            db_config,
+            *(("target", target_db) if mode in IN_PLACE_STRATEGIES else ("source", source_db)),
+        )
+        table = dict(table, row_filter=build_watermark_filter(read_client_class, table, window))
 
-        pii_columns: List[Dict[str, Any]] = [
-            col for col in table["columns"] if col.get("pii") == "Y"
+    if mode == "upsert" and masking_plan.masking_engine == "udf":
+        if await process_table_in_database(
+            table, db_config, metadata, semaphore, key_columns, key_ranges, checkpoint_store
+        ):
+            if incremental:
+                checkpoint_store.commit_watermark(table["table_name"])
+            return
+
+    if mode == "upsert" and masking_plan.projection:
+        projected_columns = get_projected_columns(masking_plan, key_columns)
+        if projected_columns:
+            table = dict(table, projected_columns=projected_columns)
+
+    if mode == "rebuild":
+        if plan is not None:
+            # Rows written after a range's last saved key may be in the shadow already, so a copy
+            # that was stopped starts over into a new shadow table
+            for key_range in key_ranges:
+                checkpoint_store.save_progress(table["table_name"], key_range, None, 0)
+        await create_shadow_table(table, db_config, metadata, semaphore)
+
+    if (
+        plan is None
+        and not incremental
+        and DBFactory.get_client_class(db_config, "target", target_db) is FileSink
+    ):
+        # A table extracted from the start replaces the files of earlier runs, not adds to them
+        sink = DBFactory.get_database_client(db_config, "target", target_db)
+        try:
+            removed = sink.clear_table(table["table_name"])
+        finally:
+            sink.close()
+        if removed:
+            logging.info(f"Removed {removed} earlier extract files of {table['table_name']}")
+
+    # Each key range runs as its own sub-task with its own connections under the shared semaphore
+    await run_together(
+        [
+            process_table_range(
+                table,
+                db_config,
+                pii_manifest,
+                semaphore,
+                mode,
+                key_columns,
+                key_range,
+                checkpoint_store,
+            )
+            for key_range in key_ranges
         ]
-        primary_key: List[str] = table.get("primary_key")
+    )
+    if mode == "rebuild":
+        await swap_shadow_table(table, db_config, metadata, semaphore)
+    if incremental:
+        checkpoint_store.commit_watermark(table["table_name"])
 
-        if mode == "upsert":
-            db_client = DBFactory.get_database_client(db_config, "target", target_db)
-            if "extraction_logic" in table:
-                db_client.delete_unwanted_data(table)
-            logging.debug(f"going to process for {table['table_name']}")
-            await process_table_in_batches(
-                db_client, table, pii_manifest["metadata"], table["schema"]
+
+async def create_shadow_table(
+    table: Dict[str, Any],
+    db_config: Dict[str, Any],
+    metadata: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+) -> None:
+    client_class = DBFactory.get_client_class(db_config, "target", metadata["target_db"])
+    if not hasattr(client_class, "create_shadow_table"):
+        raise ValueError(
+            f"{table['table_name']}: target {metadata['target_db']} does not support rebuild"
+        )
+    async with semaphore:
+        db_client = DBFactory.get_shared_client(db_config, "target", metadata["target_db"])
+        await db_client.run_blocking(
+            db_client.create_shadow_table, table["table_name"], get_shadow_table(table)
+        )
+
+
+async def swap_shadow_table(
+    table: Dict[str, Any],
+    db_config: Dict[str, Any],
+    metadata: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+) -> None:
+    # Indexes are built over the whole masked copy at once, then the copy replaces the table
+    async with semaphore:
+        db_client = DBFactory.get_shared_client(db_config, "target", metadata["target_db"])
+        with get_metrics().timer("batch_seconds", table=table["table_name"], stage="swap"):
+            swapped = await db_client.run_blocking(
+                db_client.swap_shadow_table, table["table_name"], get_shadow_table(table)
             )
-        elif mode == "extract_mask_load":
-            source_db_client = DBFactory.get_database_client(db_config, "source", source_db)
-            target_db_client = DBFactory.get_database_client(db_config, "target", target_db)
+    if not swapped:
+        logging.info(f"{table['table_name']} has no shadow table left, it was swapped in already")
+
+
+async def process_table_in_database(
+    table: Dict[str, Any],
+    db_config: Dict[str, Any],
+    metadata: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+    key_columns: List[str],
+    key_ranges: List[KeyRange],
+    checkpoint_store: Optional[CheckpointStore] = None,
+) -> bool:
+    # Mask with one UPDATE that calls the cipher as a SQL function, returns False if not possible
+    table_name = table["table_name"]
+    client_class = DBFactory.get_client_class(db_config, "target", metadata["target_db"])
+    if not hasattr(client_class, "mask_table_in_database"):
+        logging.warning(f"{table_name}: target does not support in-database masking, using Python")
+        return False
+    plan = get_table_plan(table, metadata)
+    if any(key in plan.pii_column_names for key in key_columns):
+        # A single UPDATE of a masked key can collide with keys it has not rewritten yet
+        logging.warning(f"{table_name}: primary key is masked, in-database masking not used")
+        return False
+
+    assignments: Dict[str, str] = {}
+    for column in plan.pii_columns:
+        if column.format_type is not None:
+            assignments[column.column_name] = (
+                f"{MASKING_FUNCTION_NAME}({column.column_name}, '{column.format_type}')"
+            )
+        else:
+            assignments[column.column_name] = (
+                f"CASE WHEN {column.column_name} IS NULL THEN NULL ELSE 'standard_masked_value' END"
+            )
+    where_clause, params = table.get("row_filter") or ("", ())
+
+    async with semaphore:
+        db_client = DBFactory.get_shared_client(db_config, "target", metadata["target_db"])
+        await db_client.run_blocking(
+            db_client.register_masking_function,
+            MASKING_FUNCTION_NAME,
+            build_scalar_masker(metadata),
+        )
+        updated_rows = await db_client.run_blocking(
+            db_client.mask_table_in_database, table_name, assignments, where_clause, params
+        )
+
+    if checkpoint_store is not None:
+        for key_range in key_ranges:
+            checkpoint_store.save_progress(table_name, key_range, None, updated_rows, STATUS_DONE)
+    return True
+
+
+async def process_table_range(
+    table: Dict[str, Any],
+    db_config: Dict[str, Any],
+    pii_manifest: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+    mode: str,
+    key_columns: List[str],
+    key_range: KeyRange,
+    checkpoint_store: Optional[CheckpointStore] = None,
+) -> None:
+    metadata: Dict[str, Any] = pii_manifest["metadata"]
+    wait_start = time.perf_counter()
+    async with semaphore:
+        get_metrics().observe(
+            "slot_wait_seconds", time.perf_counter() - wait_start, table=table["table_name"]
+        )
+        if mode in IN_PLACE_STRATEGIES:
+            db_client = DBFactory.get_shared_client(db_config, "target", metadata["target_db"])
+            logging.debug("going to process for %s range %s", table["table_name"], key_range)
             await process_table_in_batches(
-                source_db_client, table, pii_manifest["metadata"], table["schema"]
+                db_client,
+                table,
+                metadata,
+                table["schema"],
+                key_columns=key_columns,
+                key_range=key_range,
+                checkpoint_store=checkpoint_store,
             )
-            # In extract_mask_load, batch is fetched from source and inserted/updated in target
-            async for batch in source_db_client.extract_data_batch_by_batch(
-                table, table["schema"], BATCH_SIZE
-            ):
-                masked_batch = []
-                for row in batch:
-                    masked_row = await apply_masking(
-                        row, table["columns"], pii_manifest["metadata"]
-                    )
-                    masked_batch.append(masked_row)
-                await target_db_client.bulk_update_or_insert(
-                    table["schema"], table["table_name"], masked_batch
-                )
         else:
-            raise ValueError(f"Unsupported mode: {mode}")
+            # Batches are fetched from source, masked and loaded into target
+            source_db_client = DBFactory.get_shared_client(
+                db_config, "source", metadata.get("source_db")
+            )
+            # Extract files are not pooled, every key range writes its own through its own sink
+            target_is_file = (
+                DBFactory.get_client_class(db_config, "target", metadata["target_db"]) is FileSink
+            )
+            if target_is_file:
+                target_db_client = DBFactory.get_database_client(
+                    db_config, "target", metadata["target_db"]
+                )
+                checkpoint = (
+                    checkpoint_store.get_checkpoint(table["table_name"], key_range)
+                    if checkpoint_store is not None
+                    else None
+                )
+                if checkpoint is not None and checkpoint["status"] != STATUS_DONE:
+                    # The files of a range that stopped were deleted, so it is read again in full
+                    checkpoint_store.save_progress(table["table_name"], key_range, None, 0)
+            else:
+                target_db_client = DBFactory.get_shared_client(
+                    db_config, "target", metadata["target_db"]
+                )
+            try:
+                await process_table_in_batches(
+                    source_db_client,
+                    table,
+                    metadata,
+                    table["schema"],
+                    target_client=target_db_client,
+                    key_columns=key_columns,
+                    key_range=key_range,
+                    checkpoint_store=checkpoint_store,
+                )
+            except BaseException:
+                # A failed range leaves no extract files behind, a rerun writes it again in full
+                if target_is_file:
+                    target_db_client.abort()
+                raise
+            if target_is_file:
+                target_db_client.close()
+
+
+def open_checkpoint_store(metadata: Dict[str, Any]) -> Optional[CheckpointStore]:
+    checkpoint_config = metadata.get("checkpoint") or {}
+    if not checkpoint_config.get("enabled", False):
+        return None
+    path = checkpoint_config.get("path", os.path.join(base_dir, "..", "state", "checkpoints.db"))
+    if not os.path.isabs(path):
+        path = os.path.join(base_dir, "..", path)
+    run_id = checkpoint_config.get("run_id") or os.getenv("MASKING_RUN_ID")
+    return CheckpointStore(path, run_id)
+
+
+def get_table_pool(table: Dict[str, Any], metadata: Dict[str, Any]) -> PoolKey:
+    # A table's work is bounded by the database it is read from
+    if get_table_plan(table, metadata).strategy in IN_PLACE_STRATEGIES:
+        return "target", metadata["target_db"]
+    return "source", metadata.get("source_db")
+
+
+def get_pool_limits(db_config: Dict[str, Any]) -> Dict[PoolKey, int]:
+    return {
+        (role, db_name): int(db_settings["concurrency_limit"])
+        for role in ("source", "target")
+        for db_name, db_settings in (db_config.get(role) or {}).items()
+        if isinstance(db_settings, dict) and "concurrency_limit" in db_settings
+    }
 
 
-async def main() -> None:
+async def plan_table_jobs(
+    db_config: Dict[str, Any],
+    pii_manifest: Dict[str, Any],
+    checkpoint_store: Optional[CheckpointStore] = None,
+) -> List[TableJob]:
+    metadata: Dict[str, Any] = pii_manifest["metadata"]
+    tables = pii_manifest["tables"]
+    schedule = metadata.get("schedule", "largest_first")
+    estimates: Dict[str, Tuple[int, List[str], List[str]]] = {}
+    if schedule == "largest_first":
+        # The shared client of each database reads the size estimates, keys and foreign keys
+        for table in tables:
+            client = DBFactory.get_shared_client(db_config, *get_table_pool(table, metadata))
+            table_name = table["table_name"]
+            estimated_rows = table.get("estimated_rows")
+            if estimated_rows is None:
+                estimated_rows = await client.run_blocking(client.estimate_row_count, table_name)
+            key_columns = await get_scan_key(client, table, metadata)
+            referenced_tables = await client.run_blocking(client.get_referenced_tables, table_name)
+            estimates[table_name] = (int(estimated_rows or 0), key_columns, referenced_tables)
+    elif schedule != "manifest":
+        raise ValueError(f"Unsupported schedule: {schedule}")
+
+    # Rows referencing a masked primary key are masked after the table that owns the key
+    key_masked_tables = {
+        table["table_name"]
+        for table in tables
+        if table["table_name"] in estimates
+        and any(
+            key in get_table_plan(table, metadata).pii_column_names
+            for key in estimates[table["table_name"]][1]
+        )
+    }
+    jobs = []
+    for table in tables:
+        table_name = table["table_name"]
+        estimated_rows, _, referenced_tables = estimates.get(table_name, (0, [], []))
+        depends_on = frozenset(
+            referenced
+            for referenced in referenced_tables
+            if referenced in key_masked_tables and referenced != table_name
+        )
+
+        async def run(semaphore: asyncio.Semaphore, table: Dict[str, Any] = table) -> None:
+            await process_table(table, db_config, pii_manifest, semaphore, checkpoint_store)
+
+        jobs.append(
+            TableJob(table_name, get_table_pool(table, metadata), estimated_rows, depends_on, run)
+        )
+    return jobs
+
+
+def open_metrics_exporter(metadata: Dict[str, Any]) -> Optional[MetricsExporter]:
+    metrics_config = metadata.get("metrics") or {}
+    if not metrics_config.get("enabled", False):
+        return None
+    export_format = metrics_config.get("format", "json").lower()
+    default_name = "metrics.prom" if export_format == "prometheus" else "metrics.json"
+    path = metrics_config.get("path", os.path.join("state", default_name))
+    if not os.path.isabs(path):
+        path = os.path.join(base_dir, "..", path)
+    return MetricsExporter(path, export_format, float(metrics_config.get("interval", 0)))
+
+
+async def main() -> int:
+    checkpoint_store = None
+    metrics_exporter = None
     try:
         db_config, extraction_config = await load_all_configs()
         pii_manifest = load_pii_manifest(pii_manifest_path)
         pii_manifest = process_pii_manifest(pii_manifest, extraction_config)
+        # Validates the whole manifest and binds every cipher before any table is touched
+        plans = compile_manifest(pii_manifest)
+        MaskingFactory.configure_cache(pii_manifest["metadata"].get("cipher_cache_size", 32))
 
-        # Concurrency control with semaphore
+        # Concurrency is bounded per database, concurrency_limit is the default for each
         concurrency_limit: int = db_config.get("concurrency_limit", 3)
-        semaphore = asyncio.Semaphore(concurrency_limit)
+        scheduler = TableScheduler(get_pool_limits(db_config), concurrency_limit)
 
-        tasks = [
-            process_table(table, db_config, pii_manifest, semaphore)
-            for table in pii_manifest["tables"]
-        ]
+        checkpoint_store = open_checkpoint_store(pii_manifest["metadata"])
+        metrics_exporter = open_metrics_exporter(pii_manifest["metadata"])
+        if metrics_exporter is not None:
+            metrics_exporter.start()
 
-        await asyncio.gather(*tasks)
+        pii_manifest = dict(
+            pii_manifest,
+            tables=[
+                dict(table, masking_plan=plans[table["table_name"]])
+                for table in pii_manifest["tables"]
+            ],
+        )
+        jobs = await plan_table_jobs(db_config, pii_manifest, checkpoint_store)
+        await scheduler.run(jobs)
+        return 0
     except Exception as e:
         logging.error(f"Error in masking process: {str(e)}")
         logging.error(f"Traceback: {traceback.format_exc()}")
+        return 1
+    finally:
+        if checkpoint_store is not None:
+            checkpoint_store.close()
+        logging.info(f"Connection pool stats: {DBFactory.get_pool_stats()}")
+        DBFactory.close_shared_clients()
+        shutdown_process_executor()
+        if metrics_exporter is not None:
+            await metrics_exporter.stop()
+        logging.info(f"Cipher cache stats: {MaskingFactory.get_cache_stats()}")
+        for memo_name, memo_stats in get_memo_stats().items():
+            logging.info(f"Masking memo stats for {memo_name}: {memo_stats}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,262 @@
+"""Cooperative masking worker, any number of which share one run of the manifest.
+
+Workers lease tables and key ranges from a work queue table in the target database, so they can
+run as several processes on one host or spread over many. Run from the project root, for example:
+
+    MASKING_RUN_ID=nightly python -m main.worker --worker-id host-a-1
+    MASKING_RUN_ID=nightly python -m main.worker --worker-id host-a-2 --slots 2
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import traceback
+from typing import Any, Dict
+
+from db.db_clients import WriteGuardError
+from db.db_factory import DBFactory
+from main.pii_data_masking_pipeline import (
+    get_projected_columns,
+    get_table_plan,
+    load_all_configs,
+    open_metrics_exporter,
+    pii_manifest_path,
+    plan_table,
+    plan_table_jobs,
+    process_pii_manifest,
+    process_table_in_database,
+    process_table_range,
+)
+from masking.masking_executor import shutdown_process_executor
+from masking.masking_factory import MaskingFactory
+from masking.masking_plan import compile_manifest
+from utilities.utilities import load_pii_manifest
+from utilities.work_queue import (
+    STATUS_FAILED,
+    STATUS_LEASED,
+    STATUS_PENDING,
+    UNIT_TABLE,
+    LeasedUnitCheckpoint,
+    LeaseLostError,
+    WorkQueue,
+    WorkUnit,
+)
+
+
+async def process_unit(
+    unit: WorkUnit,
+    work_queue: WorkQueue,
+    db_config: Dict[str, Any],
+    pii_manifest: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+) -> None:
+    metadata: Dict[str, Any] = pii_manifest["metadata"]
+    table = next(
+        table for table in pii_manifest["tables"] if table["table_name"] == unit.table_name
+    )
+    masking_plan = get_table_plan(table, metadata)
+    queue_client = work_queue.db_client
+
+    if unit.unit_type == UNIT_TABLE:
+        # The first worker to lease a table plans its ranges, which the others then pick up
+        if table.get("watermark"):
+            logging.warning(
+                f"{unit.table_name}: watermarks are not kept by workers, masking every row"
+            )
+        key_columns, key_ranges, _ = await plan_table(table, db_config, metadata, semaphore)
+        if masking_plan.strategy == "upsert" and masking_plan.masking_engine == "udf":
+            if await process_table_in_database(
+                table, db_config, metadata, semaphore, key_columns, key_ranges
+            ):
+                if not await queue_client.run_blocking(work_queue.complete, unit):
+                    raise LeaseLostError(
+                        f"Lease on {unit.unit_id} lost by worker {work_queue.worker_id}"
+                    )
+                return
+        await queue_client.run_blocking(work_queue.split, unit, key_columns, key_ranges)
+        return
+
+    if masking_plan.strategy == "upsert" and masking_plan.projection:
+        projected_columns = get_projected_columns(masking_plan, unit.key_columns)
+        if projected_columns:
+            table = dict(table, projected_columns=projected_columns)
+    checkpoint = LeasedUnitCheckpoint(work_queue, unit)
+    await process_table_range(
+        table,
+        db_config,
+        pii_manifest,
+        semaphore,
+        masking_plan.strategy,
+        unit.key_columns,
+        unit.key_range,
+        checkpoint,
+    )
+    if not await queue_client.run_blocking(work_queue.complete, unit, checkpoint.rows_processed):
+        raise LeaseLostError(f"Lease on {unit.unit_id} lost by worker {work_queue.worker_id}")
+
+
+async def keep_lease(work_queue: WorkQueue, unit: WorkUnit) -> None:
+    # Returns only once another worker has taken the unit over
+    while True:
+        await asyncio.sleep(work_queue.lease_seconds / 3)
+        try:
+            if not await work_queue.db_client.run_blocking(work_queue.heartbeat, unit):
+                return
+        except Exception as e:
+            logging.warning(f"Heartbeat for {unit.unit_id} failed: {str(e)}")
+
+
+async def run_unit(
+    unit: WorkUnit,
+    work_queue: WorkQueue,
+    db_config: Dict[str, Any],
+    pii_manifest: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+) -> None:
+    work = asyncio.ensure_future(process_unit(unit, work_queue, db_config, pii_manifest, semaphore))
+    lease = asyncio.ensure_future(keep_lease(work_queue, unit))
+    try:
+        await asyncio.wait({work, lease}, return_when=asyncio.FIRST_COMPLETED)
+        if not work.done():
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+            raise LeaseLostError(f"Lease on {unit.unit_id} lost by worker {work_queue.worker_id}")
+        work.result()
+        logging.info(f"Worker {work_queue.worker_id} finished {unit.unit_id}")
+    except (LeaseLostError, WriteGuardError):
+        # Another worker resumes the unit from its last saved key, this one must not write again
+        logging.warning(
+            f"Lease on {unit.unit_id} lost by worker {work_queue.worker_id}, stopped working on it"
+        )
+    except asyncio.CancelledError:
+        work.cancel()
+        await asyncio.gather(work, return_exceptions=True)
+        await work_queue.db_client.run_blocking(work_queue.release, unit)
+        raise
+    except Exception as e:
+        status = await work_queue.db_client.run_blocking(
+            work_queue.fail, unit, f"{type(e).__name__}: {str(e)}"
+        )
+        logging.error(f"{unit.unit_id} failed on attempt {unit.attempts}, now {status}: {str(e)}")
+        logging.error(f"Traceback: {traceback.format_exc()}")
+    finally:
+        lease.cancel()
+
+
+async def run_slot(
+    work_queue: WorkQueue,
+    db_config: Dict[str, Any],
+    pii_manifest: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+    poll_seconds: float,
+) -> None:
+    while True:
+        unit = await work_queue.db_client.run_blocking(work_queue.claim)
+        if unit is None:
+            counts = await work_queue.db_client.run_blocking(work_queue.get_status_counts)
+            if not counts.get(STATUS_PENDING) and not counts.get(STATUS_LEASED):
+                return
+            # Units leased elsewhere may still be split into ranges, or come back if their worker stops
+            await asyncio.sleep(poll_seconds)
+            continue
+        await run_unit(unit, work_queue, db_config, pii_manifest, semaphore)
+
+
+async def run_worker(args: argparse.Namespace) -> int:
+    metrics_exporter = None
+    try:
+        db_config, extraction_config = await load_all_configs()
+        pii_manifest = load_pii_manifest(args.manifest)
+        pii_manifest = process_pii_manifest(pii_manifest, extraction_config)
+        plans = compile_manifest(pii_manifest)
+        metadata: Dict[str, Any] = pii_manifest["metadata"]
+        # A rebuild swaps its table in once every range is copied, which needs a single process
+        rebuilt_tables = [name for name, plan in plans.items() if plan.strategy == "rebuild"]
+        if rebuilt_tables:
+            raise ValueError(
+                f"Tables {', '.join(rebuilt_tables)} use strategy rebuild, "
+                "run them with the single-process pipeline"
+            )
+        MaskingFactory.configure_cache(metadata.get("cipher_cache_size", 32))
+        pii_manifest = dict(
+            pii_manifest,
+            tables=[
+                dict(table, masking_plan=plans[table["table_name"]])
+                for table in pii_manifest["tables"]
+            ],
+        )
+
+        settings = metadata.get("work_queue") or {}
+        queue_client = DBFactory.get_shared_client(db_config, "target", metadata["target_db"])
+        if not hasattr(queue_client, "execute_statements"):
+            raise ValueError(f"The work queue needs a database target, not {metadata['target_db']}")
+        work_queue = WorkQueue(
+            queue_client,
+            args.run_id or settings.get("run_id"),
+            args.worker_id,
+            float(args.lease_seconds or settings.get("lease_seconds", 60)),
+            int(settings.get("max_attempts", 3)),
+        )
+        await queue_client.run_blocking(work_queue.create)
+        # Every worker seeds the same tables, whichever starts first decides their order
+        jobs = await plan_table_jobs(db_config, pii_manifest)
+        if metadata.get("schedule", "largest_first") == "manifest":
+            priorities = [len(jobs) - position for position in range(len(jobs))]
+        else:
+            priorities = [job.estimated_rows for job in jobs]
+        await queue_client.run_blocking(
+            work_queue.seed_tables,
+            [(job.table_name, priority) for job, priority in zip(jobs, priorities)],
+        )
+
+        metrics_exporter = open_metrics_exporter(metadata)
+        if metrics_exporter is not None:
+            # Workers sharing a host each keep their own file
+            root, extension = os.path.splitext(metrics_exporter.path)
+            metrics_exporter.path = f"{root}.{work_queue.worker_id}{extension}"
+            metrics_exporter.start()
+
+        slots = int(args.slots or settings.get("slots") or db_config.get("concurrency_limit", 3))
+        poll_seconds = float(settings.get("poll_seconds", 5))
+        semaphore = asyncio.Semaphore(slots)
+        await asyncio.gather(
+            *[
+                run_slot(work_queue, db_config, pii_manifest, semaphore, poll_seconds)
+                for _ in range(slots)
+            ]
+        )
+        counts = await queue_client.run_blocking(work_queue.get_status_counts)
+        logging.info(f"Worker {work_queue.worker_id} done with run {work_queue.run_id}: {counts}")
+        return 1 if counts.get(STATUS_FAILED) else 0
+    except Exception as e:
+        logging.error(f"Error in masking worker: {str(e)}")
+        logging.error(f"Traceback: {traceback.format_exc()}")
+        return 1
+    finally:
+        logging.info(f"Connection pool stats: {DBFactory.get_pool_stats()}")
+        DBFactory.close_shared_clients()
+        shutdown_process_executor()
+        if metrics_exporter is not None:
+            await metrics_exporter.stop()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--manifest", default=pii_manifest_path, help="PII manifest to mask")
+    parser.add_argument(
+        "--run-id",
+        help="Run shared by the cooperating workers, defaults to work_queue.run_id, "
+        "then MASKING_RUN_ID, one of them is required",
+    )
+    parser.add_argument("--worker-id", help="Name in the lease table, defaults to host-pid")
+    parser.add_argument("--slots", type=int, help="Units this worker masks at the same time")
+    parser.add_argument(
+        "--lease-seconds", type=float, help="Lease length, renewed every third of it while working"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run_worker(parse_args())))
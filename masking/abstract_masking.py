@@ -3,11 +3,27 @@ from abc import ABC, abstractmethod
 
 class BaseMasking(ABC):
     @abstractmethod
-    async def encrypt(self, plaintext):
-        """Encrypt the plaintext and return the ciphertext."""
+    def encrypt_value(self, plaintext):
+        """Encrypt the plaintext synchronously, for callers off the event loop."""
         pass
 
     @abstractmethod
+    def decrypt_value(self, ciphertext):
+        """Decrypt the ciphertext synchronously, for callers off the event loop."""
+        pass
+
+    async def encrypt(self, plaintext):
+        """Encrypt the plaintext and return the ciphertext."""
+        return self.encrypt_value(plaintext)
+
     async def decrypt(self, ciphertext):
         """Decrypt the ciphertext and return the plaintext."""
-        pass
+        return self.decrypt_value(ciphertext)
+
+    def encrypt_many(self, values):
+        """Encrypt each of the values synchronously, engines that work on whole batches override this."""
+        return [self.encrypt_value(value) for value in values]
+
+    def decrypt_many(self, values):
+        """Decrypt each of the values synchronously, engines that work on whole batches override this."""
+        return [self.decrypt_value(value) for value in values]
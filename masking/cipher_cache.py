@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+
+class CipherCache:
+    """Bounded, thread-safe LRU cache of constructed cipher instances."""
+
+    def __init__(self, maxsize: int = 32):
+        if maxsize < 1:
+            raise ValueError("Cipher cache size must be at least 1")
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_create(self, cache_key: Hashable, factory: Callable[[], Any]) -> Any:
+        with self._lock:
+            instance = self._entries.get(cache_key)
+            if instance is not None:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return instance
+            self.misses += 1
+
+        # Build outside the lock so a slow key schedule does not block other lookups
+        instance = factory()
+
+        with self._lock:
+            existing = self._entries.get(cache_key)
+            if existing is not None:
+                self._entries.move_to_end(cache_key)
+                return existing
+            self._entries[cache_key] = instance
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return instance
+
+    def resize(self, maxsize: int) -> None:
+        if maxsize < 1:
+            raise ValueError("Cipher cache size must be at least 1")
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,146 @@
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+from ff3 import FF3Cipher
+from ff3.ff3 import HALF_TWEAK_LEN, NUM_ROUNDS, TWEAK_LEN, TWEAK_LEN_NEW, calculate_tweak64_ff3_1
+
+MIN_BATCH = 8  # Smaller groups of one length cost less value by value than through NumPy
+LIMB_BITS = 32
+LIMB_MASK = (1 << LIMB_BITS) - 1
+BLOCK_LIMBS = 4  # One 128-bit AES block as little-endian 32-bit limbs
+NUMERAL_LIMBS = 3  # The numeral half of a block, radix^length is at most 2^96
+
+
+class FF3BatchCipher:
+    """FF3-1 over many values at once, same results as the ff3 library's cipher it wraps.
+
+    Values of the same length go through each Feistel round together: their radix digits are held
+    in a NumPy array, the round numerals are built as 32-bit limbs and all round blocks go through
+    a single AES-ECB call.
+    """
+
+    def __init__(self, cipher: FF3Cipher):
+        self.cipher = cipher
+        self.radix = cipher.radix
+        codepoints = [ord(symbol) for symbol in cipher.alphabet]
+        self.symbols = np.array(codepoints, dtype=np.uint32)
+        self.digit_of = np.full(max(codepoints) + 1, -1, dtype=np.int64)
+        self.digit_of[codepoints] = np.arange(len(codepoints))
+        tweak = bytes.fromhex(cipher.tweak)
+        if len(tweak) == TWEAK_LEN_NEW:
+            tweak = calculate_tweak64_ff3_1(tweak)
+        # A tweak the library rejects leaves every value to the library, so it raises as before
+        self.tweak_halves = (
+            (bytes(tweak[:HALF_TWEAK_LEN]), bytes(tweak[HALF_TWEAK_LEN:]))
+            if len(tweak) == TWEAK_LEN
+            else None
+        )
+
+    def encrypt_many(self, values: List[str]) -> List[str]:
+        return self.transform(values, decrypt=False)
+
+    def decrypt_many(self, values: List[str]) -> List[str]:
+        return self.transform(values, decrypt=True)
+
+    def transform(self, values: List[str], decrypt: bool) -> List[str]:
+        results: List[Optional[str]] = [None] * len(values)
+        positions_by_length: Dict[int, List[int]] = {}
+        for position, value in enumerate(values):
+            positions_by_length.setdefault(len(value), []).append(position)
+        for length, positions in positions_by_length.items():
+            group = [values[position] for position in positions]
+            digits = None
+            if (
+                len(group) >= MIN_BATCH
+                and self.tweak_halves is not None
+                and self.cipher.minLen <= length <= self.cipher.maxLen
+            ):
+                digits = self.to_digits(group, length)
+            if digits is None:
+                # Too few values, or values the library rejects with its own error
+                scalar = self.cipher.decrypt if decrypt else self.cipher.encrypt
+                transformed = [scalar(value) for value in group]
+            else:
+                transformed = self.from_digits(self.feistel(digits, decrypt), length)
+            for position, value in zip(positions, transformed):
+                results[position] = value
+        return results
+
+    def to_digits(self, group: List[str], length: int) -> Optional[np.ndarray]:
+        # Digit j of a value is its j-th character, numerals are read least significant digit first
+        codepoints = np.frombuffer("".join(group).encode("utf-32-le"), dtype="<u4")
+        if codepoints.max() >= len(self.digit_of):
+            return None
+        digits = self.digit_of[codepoints]
+        if (digits < 0).any():
+            return None
+        return digits.reshape(len(group), length)
+
+    def from_digits(self, digits: np.ndarray, length: int) -> List[str]:
+        text = self.symbols[digits].astype("<u4").tobytes().decode("utf-32-le")
+        return [text[start : start + length] for start in range(0, len(text), length)]
+
+    def feistel(self, digits: np.ndarray, decrypt: bool) -> np.ndarray:
+        u = math.ceil(digits.shape[1] / 2)
+        v = digits.shape[1] - u
+        left, right = digits[:, :u], digits[:, u:]
+        tweak_left, tweak_right = self.tweak_halves
+        rounds = reversed(range(NUM_ROUNDS)) if decrypt else range(NUM_ROUNDS)
+        for i in rounds:
+            m, tweak_half = (u, tweak_right) if i % 2 == 0 else (v, tweak_left)
+            if decrypt:
+                y_digits = self.round_digits(i, tweak_half, left, m)
+                left, right = self.add_digits(right, y_digits, subtract=True), left
+            else:
+                y_digits = self.round_digits(i, tweak_half, right, m)
+                left, right = right, self.add_digits(left, y_digits)
+        return np.concatenate([left, right], axis=1)
+
+    def round_digits(self, i: int, tweak_half: bytes, half: np.ndarray, m: int) -> np.ndarray:
+        # The lowest m radix digits of y = NUM(REV(CIPH(REV(W ^ i || NUM(half)))))
+        count = half.shape[0]
+        limbs = np.zeros((count, NUMERAL_LIMBS), dtype=np.uint64)
+        for position in range(half.shape[1] - 1, -1, -1):
+            carry = half[:, position].astype(np.uint64)
+            for limb in range(NUMERAL_LIMBS):
+                total = limbs[:, limb] * np.uint64(self.radix) + carry
+                limbs[:, limb] = total & np.uint64(LIMB_MASK)
+                carry = total >> np.uint64(LIMB_BITS)
+
+        # REV(P): the numeral little-endian, then the tweak half reversed with i in its last byte
+        blocks = np.empty((count, 16), dtype=np.uint8)
+        blocks[:, :12] = limbs.astype("<u4").view(np.uint8).reshape(count, 12)
+        blocks[:, 12:] = np.frombuffer(
+            bytes([tweak_half[3] ^ i, tweak_half[2], tweak_half[1], tweak_half[0]]), dtype=np.uint8
+        )
+        encrypted = self.cipher.aesCipher.encrypt(blocks.tobytes())
+        y = np.frombuffer(encrypted, dtype="<u4").reshape(count, BLOCK_LIMBS).astype(np.uint64)
+
+        radix = np.uint64(self.radix)
+        y_digits = np.empty((count, m), dtype=np.int64)
+        for position in range(m):
+            remainder = np.zeros(count, dtype=np.uint64)
+            for limb in range(BLOCK_LIMBS - 1, -1, -1):
+                current = (remainder << np.uint64(LIMB_BITS)) | y[:, limb]
+                y[:, limb] = current // radix
+                remainder = current % radix
+            y_digits[:, position] = remainder
+        return y_digits
+
+    def add_digits(
+        self, digits: np.ndarray, y_digits: np.ndarray, subtract: bool = False
+    ) -> np.ndarray:
+        # (NUM(digits) +/- y) mod radix^m, digit by digit with the carry dropped at the top
+        result = np.empty_like(digits)
+        carry = np.zeros(digits.shape[0], dtype=np.int64)
+        for position in range(digits.shape[1]):
+            if subtract:
+                total = digits[:, position] - y_digits[:, position] - carry
+                carry = (total < 0).astype(np.int64)
+                result[:, position] = total + carry * self.radix
+            else:
+                total = digits[:, position] + y_digits[:, position] + carry
+                carry = total // self.radix
+                result[:, position] = total - carry * self.radix
+        return result
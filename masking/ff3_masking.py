@@ -1,14 +1,30 @@
 from ff3 import FF3Cipher
 from masking.abstract_masking import BaseMasking
 
+try:
+    from masking.ff3_batch import FF3BatchCipher
+except ImportError:  # NumPy is optional, without it batches are encrypted value by value
+    FF3BatchCipher = None
+
 
 class FF3Masking(BaseMasking):
     def __init__(self, key, tweak, alphabet="0123456789"):
         # Using withCustomAlphabet to support custom character sets in FF3
         self.cipher = FF3Cipher.withCustomAlphabet(key, tweak, alphabet)
+        self.batch_cipher = FF3BatchCipher(self.cipher) if FF3BatchCipher is not None else None
 
-    async def encrypt(self, plaintext):
+    def encrypt_value(self, plaintext):
         return self.cipher.encrypt(plaintext)
 
-    async def decrypt(self, ciphertext):
+    def decrypt_value(self, ciphertext):
         return self.cipher.decrypt(ciphertext)
+
+    def encrypt_many(self, values):
+        if self.batch_cipher is None:
+            return super().encrypt_many(values)
+        return self.batch_cipher.encrypt_many(values)
+
+    def decrypt_many(self, values):
+        if self.batch_cipher is None:
+            return super().decrypt_many(values)
+        return self.batch_cipher.decrypt_many(values)
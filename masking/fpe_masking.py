@@ -7,8 +7,14 @@ class FPEMasking(BaseMasking):
         self.tweak = tweak
         self.cipher = FPE.New(key, tweak, FPE.Mode[mode])
 
-    async def encrypt(self, plaintext, format_type="DIGITS"):
+    def encrypt_value(self, plaintext, format_type="DIGITS"):
         return self.cipher.encrypt(plaintext, FPE.Format[format_type])
 
-    async def decrypt(self, ciphertext, format_type="DIGITS"):
+    def decrypt_value(self, ciphertext, format_type="DIGITS"):
         return self.cipher.decrypt(ciphertext, FPE.Format[format_type])
+
+    async def encrypt(self, plaintext, format_type="DIGITS"):
+        return self.encrypt_value(plaintext, format_type)
+
+    async def decrypt(self, ciphertext, format_type="DIGITS"):
+        return self.decrypt_value(ciphertext, format_type)
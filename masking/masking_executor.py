@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from masking.masking_factory import MaskingFactory
+
+DEFAULT_CHUNK_SIZE = 1000  # Values per column shipped to a worker in one task
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor_settings(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    settings = metadata.get("masking_executor") or {}
+    workers = int(settings.get("workers") or 0) or os.cpu_count() or 1
+    return {
+        "mode": settings.get("mode", "inline").lower(),
+        "workers": workers,
+        "chunk_size": int(settings.get("chunk_size", DEFAULT_CHUNK_SIZE)),
+    }
+
+
+def get_process_executor(workers: int) -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            logging.info(f"Starting masking process pool with {workers} workers")
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def shutdown_process_executor() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+def mask_values(
+    masking_type: str, key: str, tweak: str, format_type: str, alphabet: str, values: List[Any]
+) -> List[Any]:
+    # Runs inside a worker process, MaskingFactory keeps one cipher cache per worker
+    masking_instance = MaskingFactory.get_masking_algorithm(
+        algorithm_type=masking_type,
+        key=key,
+        tweak=tweak,
+        format_type=format_type,
+        alphabet=alphabet,
+    )
+    present_values = [value for value in values if value is not None]
+    masked_values = iter(masking_instance.encrypt_many(present_values))
+    return [None if value is None else next(masked_values) for value in values]
+
+
+async def mask_column_in_pool(
+    values: List[Any],
+    masking_type: str,
+    key: str,
+    tweak: str,
+    format_type: str,
+    alphabet: str,
+    workers: int,
+    chunk_size: int,
+) -> List[Any]:
+    executor = get_process_executor(workers)
+    loop = asyncio.get_running_loop()
+    futures = [
+        loop.run_in_executor(
+            executor,
+            mask_values,
+            masking_type,
+            key,
+            tweak,
+            format_type,
+            alphabet,
+            values[start : start + chunk_size],
+        )
+        for start in range(0, len(values), chunk_size)
+    ]
+    masked_values: List[Any] = []
+    for chunk in await asyncio.gather(*futures):
+        masked_values.extend(chunk)
+    return masked_values
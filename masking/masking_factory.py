@@ -3,6 +3,7 @@ import os
 from masking.fpe_masking import FPEMasking
 from masking.ff3_masking import FF3Masking
 from masking.abstract_masking import BaseMasking
+from masking.cipher_cache import CipherCache
 
 
 class MaskingFactory:
@@ -13,12 +14,25 @@ class MaskingFactory:
         "EMAIL": "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789@._",
     }
 
+    # Key, tweak and alphabet are fixed within a run, so constructed ciphers are reused
+    cipher_cache = CipherCache(maxsize=32)
+
     @staticmethod
     def get_masking_algorithm(algorithm_type, key, tweak, format_type="DIGITS", alphabet=None):
         # Retrieve the key from the environment
         if not key:
             raise ValueError(f"Encryption Key is not set")
 
+        cache_key = (algorithm_type, key, tweak, format_type, alphabet)
+        return MaskingFactory.cipher_cache.get_or_create(
+            cache_key,
+            lambda: MaskingFactory.create_masking_algorithm(
+                algorithm_type, key, tweak, format_type, alphabet
+            ),
+        )
+
+    @staticmethod
+    def create_masking_algorithm(algorithm_type, key, tweak, format_type="DIGITS", alphabet=None):
         # Ensure key is the right length for each algorithm
         if algorithm_type == "fpe_ff1":
             if len(key) != 32:  # 128-bit key required
@@ -34,3 +48,11 @@ class MaskingFactory:
             return FF3Masking(key, tweak, alphabet=alphabet)
         else:
             raise ValueError(f"Unsupported masking algorithm: {algorithm_type}")
+
+    @staticmethod
+    def configure_cache(maxsize):
+        MaskingFactory.cipher_cache.resize(maxsize)
+
+    @staticmethod
+    def get_cache_stats():
+        return MaskingFactory.cipher_cache.stats()
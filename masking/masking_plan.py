@@ -0,0 +1,157 @@
+import logging
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from masking.masking_executor import get_executor_settings
+from masking.masking_factory import MaskingFactory
+from masking.masking_utils import ColumnMemo, get_cipher_settings, get_column_memo
+
+STRATEGIES = ("upsert", "extract_mask_load", "rebuild")
+IN_PLACE_STRATEGIES = ("upsert", "rebuild")  # Rows are read from and written back to the target
+SCAN_MODES = ("keyset", "stream", "offset")
+LOAD_MODES = ("merge", "append")
+MASKING_ENGINES = ("python", "udf")
+MASKING_ALPHABET = "STRING"  # Alphabet every FF3 cipher of the pipeline encrypts over
+
+DEFAULT_BATCH_SIZE = 10  # Batch size used when neither the table nor the manifest metadata sets one
+DEFAULT_PIPELINE_DEPTH = (
+    2  # Batches buffered between fetch, mask and write, 0 runs them in sequence
+)
+DEFAULT_SCAN_MODE = (
+    "keyset"  # keyset (WHERE pk > last_pk ORDER BY pk), stream (one cursor) or offset
+)
+
+
+class ColumnPlan(NamedTuple):
+    column_name: str
+    format_type: Optional[str]  # None for standard masking
+    masking_instance: Any  # Bound cipher, None for standard masking
+    memo: Optional[ColumnMemo]
+
+
+class TablePlan(NamedTuple):
+    """Everything the batch loop needs for one table, resolved and validated before the run."""
+
+    table_name: str
+    primary_key: Tuple[str, ...]  # From the manifest, empty when the table's own key is used
+    pii_columns: Tuple[ColumnPlan, ...]
+    pii_column_names: FrozenSet[str]
+    masking_type: str
+    key: str
+    tweak: str
+    executor: Dict[str, Any]
+    strategy: str
+    load_mode: str
+    masking_engine: str
+    scan_mode: str
+    batch_size: int
+    pipeline_depth: int
+    projection: bool
+
+
+def validate_table(table: Dict[str, Any], metadata: Dict[str, Any]) -> List[str]:
+    errors = []
+    table_name = table.get("table_name")
+    if not table_name:
+        return ["table without table_name"]
+    for field in ("schema", "columns"):
+        if field not in table:
+            errors.append(f"{table_name}: missing {field}")
+    settings = (
+        ("strategy", STRATEGIES, "upsert"),
+        ("scan_mode", SCAN_MODES, DEFAULT_SCAN_MODE),
+        ("load_mode", LOAD_MODES, "merge"),
+        ("masking_engine", MASKING_ENGINES, "python"),
+    )
+    for setting, allowed, default in settings:
+        value = table.get(setting, metadata.get(setting, default))
+        if value not in allowed:
+            errors.append(
+                f"{table_name}: unsupported {setting} {value!r}, expected one of {allowed}"
+            )
+    strategy = table.get("strategy", metadata.get("strategy", "upsert"))
+    if metadata.get("target_db") == "file" and strategy != "extract_mask_load":
+        errors.append(f"{table_name}: a file target_db only takes strategy extract_mask_load")
+    if strategy == "rebuild" and table.get("watermark"):
+        errors.append(f"{table_name}: a rebuild copies every row, it cannot take a watermark")
+    for column in table.get("columns") or []:
+        column_name = column.get("column_name")
+        if not column_name:
+            errors.append(f"{table_name}: column without column_name")
+            continue
+        if column.get("pii", "N") not in ("Y", "N"):
+            errors.append(f"{table_name}.{column_name}: pii must be Y or N")
+        masking_algorithm = column.get("masking_algorithm")
+        if masking_algorithm is not None and not isinstance(masking_algorithm, dict):
+            errors.append(f"{table_name}.{column_name}: masking_algorithm must be a mapping")
+    if table.get("watermark") and not table["watermark"].get("column"):
+        errors.append(f"{table_name}: watermark needs a column")
+    return errors
+
+
+def compile_table_plan(table: Dict[str, Any], metadata: Dict[str, Any]) -> TablePlan:
+    errors = validate_table(table, metadata)
+    if errors:
+        raise ValueError(f"Invalid PII manifest: {'; '.join(errors)}")
+    masking_type, tweak, key = get_cipher_settings(metadata)
+    pii_columns = []
+    for column in table["columns"]:
+        if column.get("pii") != "Y":
+            continue
+        if column.get("masking_algorithm"):
+            format_type = column["masking_algorithm"].get("format", "DIGITS").upper()
+            # Built now so a bad key or algorithm fails the run before any table is touched
+            masking_instance = MaskingFactory.get_masking_algorithm(
+                algorithm_type=masking_type,
+                key=key,
+                tweak=tweak,
+                format_type=format_type,
+                alphabet=MASKING_ALPHABET,
+            )
+            memo = get_column_memo(table["table_name"], column, metadata)
+            pii_columns.append(
+                ColumnPlan(column["column_name"], format_type, masking_instance, memo)
+            )
+        else:
+            pii_columns.append(ColumnPlan(column["column_name"], None, None, None))
+    primary_key = table.get("primary_key") or []
+    if isinstance(primary_key, str):
+        primary_key = [primary_key]
+
+    def setting(name: str, default: Any) -> Any:
+        return table.get(name, metadata.get(name, default))
+
+    return TablePlan(
+        table_name=table["table_name"],
+        primary_key=tuple(primary_key),
+        pii_columns=tuple(pii_columns),
+        pii_column_names=frozenset(column.column_name for column in pii_columns),
+        masking_type=masking_type,
+        key=key,
+        tweak=tweak,
+        executor=get_executor_settings(metadata),
+        strategy=setting("strategy", "upsert"),
+        load_mode=setting("load_mode", "merge"),
+        masking_engine=setting("masking_engine", "python"),
+        scan_mode=setting("scan_mode", DEFAULT_SCAN_MODE),
+        batch_size=int(setting("batch_size", DEFAULT_BATCH_SIZE)),
+        pipeline_depth=int(setting("pipeline_depth", DEFAULT_PIPELINE_DEPTH)),
+        projection=bool(setting("projection", True)),
+    )
+
+
+def compile_manifest(pii_manifest: Dict[str, Any]) -> Dict[str, TablePlan]:
+    """Validate the whole manifest and compile one plan per table, reporting every problem at once."""
+    metadata = pii_manifest.get("metadata") or {}
+    errors = [
+        f"metadata: missing {field}" for field in ("fpe", "target_db") if field not in metadata
+    ]
+    tables = pii_manifest.get("tables") or []
+    names = [table.get("table_name") for table in tables]
+    errors += [f"{name}: listed more than once" for name in set(names) if names.count(name) > 1]
+    for table in tables:
+        errors += validate_table(table, metadata)
+    if errors:
+        raise ValueError(f"Invalid PII manifest: {'; '.join(errors)}")
+    plans = {table["table_name"]: compile_table_plan(table, metadata) for table in tables}
+    logging.info(f"Compiled masking plans for {len(plans)} tables")
+    return plans
@@ -1,61 +1,212 @@
 import asyncio
 import logging
+import sys
+from collections import OrderedDict
+from db.record_batch import RecordBatch
 from masking.masking_factory import MaskingFactory
+from masking.masking_executor import mask_column_in_pool
+from utilities.metrics import get_metrics
 import os
-from typing import List, Dict, Any
+from typing import TYPE_CHECKING, List, Dict, Any, Callable, Optional, Tuple
 
+if TYPE_CHECKING:
+    from masking.masking_plan import TablePlan
 
-async def apply_masking(data: List[Dict[str, Any]], columns: List[Dict[str, Any]], metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
-    masked_data = []
+DEFAULT_MEMO_MAX_ENTRIES = 100000  # Distinct plaintexts remembered per column
+DEFAULT_MEMO_MAX_BYTES = 64 * 1024 * 1024  # Approximate memory bound per column memo
 
-    # Extract algorithm-related metadata once for the entire batch
+
+class ColumnMemo:
+    """LRU of plaintext -> ciphertext for one column, valid while key and tweak are fixed."""
+
+    def __init__(self, max_entries: int = DEFAULT_MEMO_MAX_ENTRIES, max_bytes: int = DEFAULT_MEMO_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Any, Any]" = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, value: Any) -> Optional[Any]:
+        masked_value = self.entries.get(value)
+        if masked_value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(value)
+        self.hits += 1
+        return masked_value
+
+    def put(self, value: Any, masked_value: Any) -> None:
+        if value in self.entries:
+            return
+        self.entries[value] = masked_value
+        self.size_bytes += sys.getsizeof(value) + sys.getsizeof(masked_value)
+        while self.entries and (len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes):
+            old_value, old_masked_value = self.entries.popitem(last=False)
+            self.size_bytes -= sys.getsizeof(old_value) + sys.getsizeof(old_masked_value)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_column_memos: Dict[str, ColumnMemo] = {}
+
+
+def get_column_memo(
+    table_name: Optional[str], column: Dict[str, Any], metadata: Dict[str, Any]
+) -> Optional[ColumnMemo]:
+    masking_algorithm = column.get("masking_algorithm") or {}
+    if not masking_algorithm.get("memoize", False):
+        return None
+    memo_name = f"{table_name}.{column['column_name']}" if table_name else column["column_name"]
+    memo = _column_memos.get(memo_name)
+    if memo is None:
+        defaults = metadata.get("memo") or {}
+        memo = ColumnMemo(
+            max_entries=int(masking_algorithm.get("memo_max_entries", defaults.get("max_entries", DEFAULT_MEMO_MAX_ENTRIES))),
+            max_bytes=int(masking_algorithm.get("memo_max_bytes", defaults.get("max_bytes", DEFAULT_MEMO_MAX_BYTES))),
+        )
+        _column_memos[memo_name] = memo
+    return memo
+
+
+def get_memo_stats() -> Dict[str, Dict[str, Any]]:
+    return {memo_name: memo.stats() for memo_name, memo in _column_memos.items()}
+
+
+def clear_memos() -> None:
+    _column_memos.clear()
+
+
+def get_cipher_settings(metadata: Dict[str, Any]) -> Tuple[str, str, str]:
     masking_type = metadata["fpe"].get("masking_type", "ff3").lower()
     tweak = metadata["fpe"].get("tweak", "CBD09280979564")
     key_env_var = metadata["fpe"].get("key_env_var", "FPE_KEY")
     key = os.getenv(key_env_var, "2DE79D232DF5585D68CE47882AE256D6")
+    logging.debug("Masking Type: %s, Key Environment Variable: %s", masking_type, key_env_var)
+    return masking_type, tweak, key
+
+
+def build_scalar_masker(metadata: Dict[str, Any]) -> Callable[[Any, str], Any]:
+    # Same cipher and alphabet as apply_masking, for callers that mask one value at a time (SQL UDFs)
+    masking_type, tweak, key = get_cipher_settings(metadata)
+
+    def mask_value(value: Any, format_type: str = "DIGITS") -> Any:
+        if value is None:
+            return None
+        masking_instance = MaskingFactory.get_masking_algorithm(
+            algorithm_type=masking_type,
+            key=key,
+            tweak=tweak,
+            format_type=(format_type or "DIGITS").upper(),
+            alphabet="STRING",
+        )
+        return masking_instance.encrypt_value(str(value))
+
+    return mask_value
+
+
+def mask_column(values: List[Any], masking_instance: Any, memo: Optional[ColumnMemo] = None) -> List[Any]:
+    masked_values: List[Any] = [None] * len(values)  # NULL stays NULL
+    # Values the memo does not know are encrypted together, each distinct value once
+    pending: Dict[Any, List[int]] = {}
+    for position, value in enumerate(values):
+        if value is None:
+            continue
+        if value in pending:
+            pending[value].append(position)
+            continue
+        masked_value = memo.get(value) if memo is not None else None
+        if masked_value is None:
+            pending[value] = [position]
+        else:
+            masked_values[position] = masked_value
+    for value, masked_value in zip(pending, masking_instance.encrypt_many(list(pending))):
+        for position in pending[value]:
+            masked_values[position] = masked_value
+        if memo is not None:
+            memo.put(value, masked_value)
+    return masked_values
+
+
+async def apply_masking(data: RecordBatch, plan: "TablePlan") -> RecordBatch:
+    # The plan already holds the bound ciphers, formats and memos of the table's PII columns
+    if plan.executor["mode"] == "process":
+        return await apply_masking_in_pool(data, plan)
+
+    # Mask column by column, the input batch is left as read
+    masked_columns: Dict[str, List[Any]] = {}
+    for column in plan.pii_columns:
+        values = data.column(column.column_name)
+        if column.masking_instance is not None:
+            with get_metrics().timer(
+                "cipher_seconds", table=plan.table_name, column=column.column_name
+            ):
+                masked_columns[column.column_name] = mask_column(
+                    values, column.masking_instance, column.memo
+                )
+            get_metrics().inc(
+                "values_masked_total", len(values), table=plan.table_name, column=column.column_name
+            )
+            await asyncio.sleep(0)  # Let other tables' fetches and writes progress between columns
+        else:
+            # Apply standard masking (e.g., SHA2)
+            masked_columns[column.column_name] = [
+                None if value is None else "standard_masked_value" for value in values
+            ]
+    return data.with_columns(masked_columns)
+
 
-    logging.debug(f"Masking Type: {masking_type}, Tweak: {tweak}, Key Environment Variable: {key_env_var}")
-
-    masking_tasks = []
-
-    # Prepare masking tasks for each row and each column
-    for row_index, row in enumerate(data):
-        logging.debug(f"Processing row {row_index + 1}/{len(data)}")
-        for column in columns:
-            value = row[column["column_name"]]
-            if column.get("masking_algorithm"):
-                # Apply custom masking algorithm based on configuration
-                format_type = column["masking_algorithm"].get("format", "DIGITS").upper()
-                logging.debug(f"Applying masking for column: {column['column_name']}, Format Type: {format_type}")
-                masking_tasks.append(
-                    fpe_encrypt_async(
-                        value, masking_type, format_type, tweak, key, row, column["column_name"]
-                    )
+async def apply_masking_in_pool(data: RecordBatch, plan: "TablePlan") -> RecordBatch:
+    # Mask column by column so each worker task gets one cipher and a contiguous chunk of values
+    masked_columns: Dict[str, List[Any]] = {}
+    for column in plan.pii_columns:
+        values = data.column(column.column_name)
+        if column.masking_instance is not None:
+            memo = column.memo
+            # Only distinct values the memo has not seen are shipped to the workers
+            pending = values
+            if memo is not None:
+                known = {}
+                for value in values:
+                    if value not in known:
+                        known[value] = memo.get(value)
+                pending = [value for value, masked_value in known.items() if masked_value is None]
+            with get_metrics().timer(
+                "cipher_seconds", table=plan.table_name, column=column.column_name
+            ):
+                masked_pending = await mask_column_in_pool(
+                    pending,
+                    plan.masking_type,
+                    plan.key,
+                    plan.tweak,
+                    column.format_type,
+                    "STRING",
+                    plan.executor["workers"],
+                    plan.executor["chunk_size"],
                 )
+            get_metrics().inc(
+                "values_masked_total", len(values), table=plan.table_name, column=column.column_name
+            )
+            if memo is not None:
+                for value, masked_value in zip(pending, masked_pending):
+                    known[value] = masked_value
+                    memo.put(value, masked_value)
+                masked_columns[column.column_name] = [known[value] for value in values]
             else:
-                # Apply standard masking (e.g., SHA2)
-                logging.debug(f"Applying standard masking for column: {column['column_name']}")
-                row[column["column_name"]] = "standard_masked_value"
-        masked_data.append(row)
-
-    # Run all masking tasks concurrently
-    logging.debug(f"Running {len(masking_tasks)} masking tasks concurrently")
-    await asyncio.gather(*masking_tasks)
-    return masked_data
-
-
-async def fpe_encrypt_async(value: str, masking_type: str, format_type: str, tweak: str, key: str, masked_row: Dict[str, Any], column_name: str) -> None:
-    await asyncio.sleep(0)  # Simulate async behavior
-    masking_instance = MaskingFactory.get_masking_algorithm(
-        algorithm_type=masking_type,
-        key=key,
-        tweak=tweak,
-        format_type=format_type,
-        alphabet="STRING",
-    )
-
-    logging.debug(f"Encrypting value for column: {column_name}")
-    # Encrypt the value and update the masked row
-    masked_value = await masking_instance.encrypt(value)
-    masked_row[column_name] = masked_value
-    logging.debug(f"Masked value for column {column_name}: {masked_value}")
+                masked_columns[column.column_name] = masked_pending
+        else:
+            masked_columns[column.column_name] = [
+                None if value is None else "standard_masked_value" for value in values
+            ]
+    return data.with_columns(masked_columns)
@@ -0,0 +1,27 @@
+CREATE TABLE IF NOT EXISTS table_plan (
+    run_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    key_columns TEXT NOT NULL,
+    key_ranges TEXT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (run_id, table_name)
+);
+
+CREATE TABLE IF NOT EXISTS table_checkpoint (
+    run_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    range_id TEXT NOT NULL,
+    last_key TEXT,
+    rows_processed INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (run_id, table_name, range_id)
+);
+
+CREATE TABLE IF NOT EXISTS table_watermark (
+    table_name TEXT PRIMARY KEY,
+    watermark_value TEXT,
+    pending_value TEXT,
+    pending_run_id TEXT,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
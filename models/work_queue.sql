@@ -0,0 +1,24 @@
+CREATE TABLE IF NOT EXISTS masking_work_unit (
+    run_id VARCHAR(128) NOT NULL,
+    unit_id VARCHAR(1024) NOT NULL,
+    table_name VARCHAR(256) NOT NULL,
+    unit_type VARCHAR(16) NOT NULL,
+    key_columns TEXT,
+    lower_key TEXT,
+    upper_key TEXT,
+    priority BIGINT NOT NULL DEFAULT 0,
+    status VARCHAR(16) NOT NULL,
+    worker_id VARCHAR(256),
+    lease_token VARCHAR(64),
+    lease_expires_at DOUBLE PRECISION,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_key TEXT,
+    rows_processed BIGINT NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at DOUBLE PRECISION,
+    PRIMARY KEY (run_id, unit_id)
+);
+
+CREATE INDEX IF NOT EXISTS masking_work_unit_claim ON masking_work_unit (run_id, status, priority);
+
+CREATE INDEX IF NOT EXISTS masking_work_unit_lease ON masking_work_unit (run_id, lease_token);
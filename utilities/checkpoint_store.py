@@ -0,0 +1,169 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+checkpoint_ddl_path = os.path.join(base_dir, "..", "models", "checkpoint.sql")
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_DONE = "done"
+
+
+def encode_key(key: Optional[Tuple[Any, ...]]) -> Optional[str]:
+    return None if key is None else json.dumps(list(key), default=str)
+
+
+def decode_key(value: Optional[str]) -> Optional[Tuple[Any, ...]]:
+    return None if value is None else tuple(json.loads(value))
+
+
+class CheckpointStore:
+    """Per-run record of the key ranges planned for each table and the last key committed in each,
+    plus the watermark each incremental table has been masked up to across runs."""
+
+    def __init__(self, path: str, run_id: Optional[str] = None):
+        self.path = path
+        # Only a run started again under its run id resumes, a target reloaded for a new run must
+        # not have its tables skipped as already masked
+        self.run_id = run_id or f"{datetime.datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=wal")
+        self.lock = threading.Lock()
+        with open(checkpoint_ddl_path) as ddl_file:
+            self.connection.executescript(ddl_file.read())
+        logging.info(
+            f"Checkpoint store {path} opened for run {self.run_id}, "
+            f"set MASKING_RUN_ID={self.run_id} to resume it"
+        )
+
+    def get_plan(self, table_name: str) -> Optional[Tuple[List[str], List[Tuple[Any, Any]]]]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT key_columns, key_ranges FROM table_plan WHERE run_id = ? AND table_name = ?",
+                (self.run_id, table_name),
+            ).fetchone()
+        if row is None:
+            return None
+        key_ranges = [(decode_key(lower), decode_key(upper)) for lower, upper in json.loads(row[1])]
+        return json.loads(row[0]), key_ranges
+
+    def save_plan(
+        self, table_name: str, key_columns: List[str], key_ranges: List[Tuple[Any, Any]]
+    ) -> None:
+        encoded_ranges = [[encode_key(lower), encode_key(upper)] for lower, upper in key_ranges]
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO table_plan (run_id, table_name, key_columns, key_ranges) VALUES (?, ?, ?, ?)",
+                (self.run_id, table_name, json.dumps(key_columns), json.dumps(encoded_ranges)),
+            )
+
+    @staticmethod
+    def range_id(key_range: Tuple[Any, Any]) -> str:
+        return json.dumps([encode_key(key_range[0]), encode_key(key_range[1])])
+
+    def get_checkpoint(
+        self, table_name: str, key_range: Tuple[Any, Any]
+    ) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT last_key, rows_processed, status FROM table_checkpoint "
+                "WHERE run_id = ? AND table_name = ? AND range_id = ?",
+                (self.run_id, table_name, self.range_id(key_range)),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"last_key": decode_key(row[0]), "rows_processed": row[1], "status": row[2]}
+
+    def save_progress(
+        self,
+        table_name: str,
+        key_range: Tuple[Any, Any],
+        last_key: Optional[Tuple[Any, ...]],
+        rows_processed: int,
+        status: str = STATUS_IN_PROGRESS,
+    ) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO table_checkpoint "
+                "(run_id, table_name, range_id, last_key, rows_processed, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                (
+                    self.run_id,
+                    table_name,
+                    self.range_id(key_range),
+                    encode_key(last_key),
+                    rows_processed,
+                    status,
+                ),
+            )
+
+    def get_write_guard(
+        self,
+        db_client: Any,
+        table_name: str,
+        key_range: Tuple[Any, Any],
+        last_key: Optional[Tuple[Any, ...]],
+        rows_processed: int,
+    ) -> Optional[Tuple[str, Tuple[Any, ...]]]:
+        # Checkpoints live in their own file, outside any transaction of the database written to
+        return None
+
+    def is_table_done(self, table_name: str) -> bool:
+        plan = self.get_plan(table_name)
+        if plan is None:
+            return False
+        return all(
+            (checkpoint := self.get_checkpoint(table_name, key_range)) is not None
+            and checkpoint["status"] == STATUS_DONE
+            for key_range in plan[1]
+        )
+
+    def get_watermark(self, table_name: str) -> Optional[Any]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT watermark_value FROM table_watermark WHERE table_name = ?", (table_name,)
+            ).fetchone()
+        key = decode_key(row[0]) if row else None
+        return key[0] if key else None
+
+    def get_watermark_window(self, table_name: str) -> Optional[Tuple[Any, Any]]:
+        # The (committed, pending) window opened by this run, if it has not been committed yet
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT watermark_value, pending_value FROM table_watermark "
+                "WHERE table_name = ? AND pending_run_id = ?",
+                (table_name, self.run_id),
+            ).fetchone()
+        if row is None:
+            return None
+        low, high = decode_key(row[0]), decode_key(row[1])
+        return (low[0] if low else None), (high[0] if high else None)
+
+    def start_watermark_window(self, table_name: str, high: Any) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO table_watermark (table_name, pending_value, pending_run_id) VALUES (?, ?, ?) "
+                "ON CONFLICT (table_name) DO UPDATE SET pending_value = excluded.pending_value, "
+                "pending_run_id = excluded.pending_run_id, updated_at = CURRENT_TIMESTAMP",
+                (table_name, None if high is None else encode_key((high,)), self.run_id),
+            )
+
+    def commit_watermark(self, table_name: str) -> None:
+        # Advance only once every range of the table is done, an empty window keeps the old value
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE table_watermark SET watermark_value = COALESCE(pending_value, watermark_value), "
+                "pending_value = NULL, pending_run_id = NULL, updated_at = CURRENT_TIMESTAMP "
+                "WHERE table_name = ? AND pending_run_id = ?",
+                (table_name, self.run_id),
+            )
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
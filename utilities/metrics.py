@@ -0,0 +1,184 @@
+import asyncio
+import bisect
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+METRIC_PREFIX = "masking_"  # Prefix of every metric name in the Prometheus export
+# Upper bounds in seconds of the latency buckets, the last bucket is +Inf
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        total = 0
+        cumulative = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class MetricsRegistry:
+    """Process-wide counters and latency histograms, labelled by table, stage and the like."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    @staticmethod
+    def labels(labels: Dict[str, Any]) -> Labels:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        metric_key = (name, self.labels(labels))
+        with self.lock:
+            self.counters[metric_key] = self.counters.get(metric_key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        metric_key = (name, self.labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(metric_key)
+            if histogram is None:
+                histogram = self.histograms[metric_key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": round(histogram.sum, 6),
+                        "max": round(histogram.max, 6),
+                        "buckets": dict(histogram.cumulative_counts()),
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+            }
+
+    def to_prometheus(self) -> str:
+        def format_labels(labels: Labels, extra: Labels = ()) -> str:
+            pairs = [f'{name}="{value}"' for name, value in labels + extra]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self.lock:
+            declared = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric_name = f"{METRIC_PREFIX}{name}"
+                if metric_name not in declared:
+                    lines.append(f"# TYPE {metric_name} counter")
+                    declared.add(metric_name)
+                lines.append(f"{metric_name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric_name = f"{METRIC_PREFIX}{name}"
+                if metric_name not in declared:
+                    lines.append(f"# TYPE {metric_name} histogram")
+                    declared.add(metric_name)
+                for bound, count in histogram.cumulative_counts():
+                    lines.append(
+                        f"{metric_name}_bucket{format_labels(labels, (('le', bound),))} {count}"
+                    )
+                lines.append(f"{metric_name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric_name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, export_format: str = "json") -> None:
+        content = (
+            self.to_prometheus()
+            if export_format == "prometheus"
+            else json.dumps(self.snapshot(), indent=2, default=str) + "\n"
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Readers such as a textfile collector never see a half-written file
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics() -> MetricsRegistry:
+    return _registry
+
+
+class MetricsExporter:
+    """Writes the registry to a file every interval seconds while running, and once at stop."""
+
+    def __init__(
+        self,
+        path: str,
+        export_format: str = "json",
+        interval: float = 0,
+        registry: Optional[MetricsRegistry] = None,
+    ):
+        self.path = path
+        self.export_format = export_format
+        self.interval = interval
+        self.registry = registry or get_metrics()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.registry.write(self.path, self.export_format)
+            except OSError as e:
+                logging.error(f"Failed to export metrics to {self.path}: {str(e)}")
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.registry.write(self.path, self.export_format)
+        logging.info(f"Metrics exported to {self.path}")
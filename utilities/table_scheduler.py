@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, FrozenSet, List, NamedTuple, Set, Tuple
+
+PoolKey = Tuple[str, str]  # (role, database name) whose connections a table's work holds
+
+
+class TableJob(NamedTuple):
+    table_name: str
+    pool: PoolKey
+    estimated_rows: int
+    depends_on: FrozenSet[str]  # Tables that must finish before this one starts
+    run: Callable[[asyncio.Semaphore], Awaitable[None]]
+
+
+def drop_cyclic_dependencies(jobs: List[TableJob]) -> List[TableJob]:
+    # A foreign key cycle has no valid order, its tables are scheduled as if independent
+    dependencies = {job.table_name: set(job.depends_on) for job in jobs}
+    cyclic: Set[str] = set()
+    explored: Set[str] = set()
+
+    def visit(table_name: str, path: List[str]) -> None:
+        if table_name in path:
+            cyclic.update(path[path.index(table_name) :])
+            return
+        if table_name in explored:
+            return
+        for dependency in dependencies.get(table_name, ()):
+            visit(dependency, path + [table_name])
+        explored.add(table_name)
+
+    for table_name in dependencies:
+        visit(table_name, [])
+    if cyclic:
+        logging.warning(f"Foreign key cycle between {sorted(cyclic)}, ordering ignored for them")
+    return [
+        (
+            job._replace(depends_on=frozenset(job.depends_on - cyclic))
+            if job.table_name in cyclic
+            else job
+        )
+        for job in jobs
+    ]
+
+
+class TableScheduler:
+    """Starts the largest tables first, holds back tables until the tables they depend on finish,
+    and bounds concurrent work per database instead of across the whole run."""
+
+    def __init__(self, pool_limits: Dict[PoolKey, int], default_limit: int = 3):
+        self.pool_limits = pool_limits
+        self.default_limit = default_limit
+        self.semaphores: Dict[PoolKey, asyncio.Semaphore] = {}
+
+    def get_semaphore(self, pool: PoolKey) -> asyncio.Semaphore:
+        if pool not in self.semaphores:
+            self.semaphores[pool] = asyncio.Semaphore(
+                self.pool_limits.get(pool, self.default_limit)
+            )
+        return self.semaphores[pool]
+
+    async def run(self, jobs: List[TableJob]) -> None:
+        jobs = drop_cyclic_dependencies(jobs)
+        scheduled = {job.table_name for job in jobs}
+        finished: Dict[str, asyncio.Future] = {
+            job.table_name: asyncio.get_running_loop().create_future() for job in jobs
+        }
+        failed: Set[str] = set()
+
+        async def start(job: TableJob) -> None:
+            try:
+                for dependency in job.depends_on & scheduled:
+                    await finished[dependency]
+                blocked_by = sorted(job.depends_on & failed)
+                if blocked_by:
+                    raise RuntimeError(f"{job.table_name} skipped, {blocked_by} did not finish")
+                logging.info(
+                    f"Starting {job.table_name} (~{job.estimated_rows} rows) on {job.pool[0]} {job.pool[1]}"
+                )
+                await job.run(self.get_semaphore(job.pool))
+            except BaseException:
+                failed.add(job.table_name)
+                raise
+            finally:
+                finished[job.table_name].set_result(None)
+
+        # Semaphores admit waiters in arrival order, so tasks are created largest first
+        ordered = sorted(jobs, key=lambda job: job.estimated_rows, reverse=True)
+        results = await asyncio.gather(*[start(job) for job in ordered], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for job, result in zip(ordered, results):
+            if isinstance(result, BaseException):
+                logging.error(f"Table {job.table_name} failed: {str(result)}")
+        if errors:
+            raise errors[0]
@@ -23,10 +23,28 @@ def load_pii_manifest(file_path):
 # Replace Jinja parameters in the PII Manifest
 def replace_jinja_parameters(manifest, extraction_config):
     try:
-        manifest_str = yaml.dump(manifest)
-        template = jinja2.Template(manifest_str)
-        rendered_manifest_str = template.render(**extraction_config)
-        return yaml.safe_load(rendered_manifest_str)
+        environment = jinja2.Environment()
+
+        # Only strings holding template syntax are rendered, everything else is reused as is.
+        # A rendered scalar is parsed as YAML again, so "{{ batch_size }}" comes back as an int
+        # the way it would had it been written into the manifest directly.
+        def render(value):
+            if isinstance(value, str):
+                if "{" not in value:
+                    return value
+                rendered = environment.from_string(value).render(**extraction_config)
+                try:
+                    parsed = yaml.safe_load(rendered)
+                except yaml.YAMLError:
+                    return rendered
+                return rendered if isinstance(parsed, (dict, list)) or parsed is None else parsed
+            if isinstance(value, dict):
+                return {key: render(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [render(item) for item in value]
+            return value
+
+        return render(manifest)
     except Exception as e:
         logging.error(f"Failed to replace Jinja parameters in PII manifest: {str(e)}")
         raise
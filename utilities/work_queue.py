@@ -0,0 +1,340 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from utilities.checkpoint_store import STATUS_DONE, CheckpointStore, decode_key, encode_key
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+work_queue_ddl_path = os.path.join(base_dir, "..", "models", "work_queue.sql")
+
+UNIT_TABLE = "table"  # A table whose key ranges have not been planned yet
+UNIT_RANGE = "range"  # One planned key range of a table
+
+STATUS_PENDING = "pending"
+STATUS_LEASED = "leased"
+STATUS_FAILED = "failed"
+
+UNIT_COLUMNS = (
+    "unit_id, table_name, unit_type, key_columns, lower_key, upper_key, "
+    "last_key, rows_processed, attempts, priority, lease_token"
+)
+
+
+class LeaseLostError(RuntimeError):
+    pass
+
+
+class WorkUnit(NamedTuple):
+    unit_id: str
+    table_name: str
+    unit_type: str
+    key_columns: Optional[List[str]]
+    key_range: Tuple[Any, Any]
+    last_key: Optional[Tuple[Any, ...]]
+    rows_processed: int
+    attempts: int
+    priority: int
+    lease_token: str
+
+
+class WorkQueue:
+    """Tables and key ranges of one run, kept in the target database and leased to one worker at a
+    time, so workers on any number of hosts share a run without masking the same rows twice."""
+
+    def __init__(
+        self,
+        db_client: Any,
+        run_id: Optional[str] = None,
+        worker_id: Optional[str] = None,
+        lease_seconds: float = 60,
+        max_attempts: int = 3,
+    ):
+        self.db_client = db_client
+        # Given explicitly, a default shared by unrelated runs would let one skip the other's units
+        self.run_id = run_id or os.getenv("MASKING_RUN_ID")
+        if not self.run_id:
+            raise ValueError("Workers need a run id: --run-id, work_queue.run_id or MASKING_RUN_ID")
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.marker = db_client.PLACEHOLDER
+        # Progress is saved from the event loop while claims and heartbeats use the I/O threads
+        self.lock = threading.Lock()
+
+    def execute(self, *statements: Tuple[str, Tuple[Any, ...]]) -> int:
+        with self.lock:
+            return self.db_client.execute_statements(list(statements))
+
+    def fetch(
+        self, query: str, params: Tuple[Any, ...], limit: int = 1000
+    ) -> List[Tuple[Any, ...]]:
+        with self.lock:
+            batch = self.db_client.fetch_first_batch(query, limit, params)
+        return batch.rows if batch else []
+
+    def create(self) -> None:
+        with open(work_queue_ddl_path) as ddl_file:
+            statements = [statement.strip() for statement in ddl_file.read().split(";")]
+        self.execute(*[(statement, ()) for statement in statements if statement])
+        logging.info(f"Work queue ready for run {self.run_id}, worker {self.worker_id}")
+
+    def insert_statement(
+        self,
+        unit_id: str,
+        table_name: str,
+        unit_type: str,
+        priority: int,
+        key_columns: Optional[List[str]] = None,
+        key_range: Tuple[Any, Any] = (None, None),
+        held_unit: Optional[WorkUnit] = None,
+    ) -> Tuple[str, Tuple[Any, ...]]:
+        # Every worker inserts the same units, only the first insert of each takes effect
+        m = self.marker
+        guard, guard_params = "1 = 1", ()
+        if held_unit is not None:
+            # Nothing is inserted once the lease on the unit being split has been lost
+            guard = (
+                f"EXISTS (SELECT 1 FROM masking_work_unit WHERE run_id = {m} AND unit_id = {m} "
+                f"AND lease_token = {m} AND status = {m})"
+            )
+            guard_params = (self.run_id, held_unit.unit_id, held_unit.lease_token, STATUS_LEASED)
+        query = (
+            "INSERT INTO masking_work_unit (run_id, unit_id, table_name, unit_type, key_columns, "
+            "lower_key, upper_key, priority, status, updated_at) "
+            f"SELECT {m}, {m}, {m}, {m}, {m}, {m}, {m}, {m}, {m}, {m} WHERE {guard} "
+            "ON CONFLICT (run_id, unit_id) DO NOTHING"
+        )
+        params = (
+            self.run_id,
+            unit_id,
+            table_name,
+            unit_type,
+            None if key_columns is None else json.dumps(key_columns),
+            encode_key(key_range[0]),
+            encode_key(key_range[1]),
+            int(priority),
+            STATUS_PENDING,
+            time.time(),
+        ) + guard_params
+        return query, params
+
+    def seed_tables(self, tables: List[Tuple[str, int]]) -> int:
+        """Add one unplanned unit per (table name, priority), returns how many were new."""
+        added = self.execute(
+            *[
+                self.insert_statement(
+                    f"{UNIT_TABLE}:{table_name}", table_name, UNIT_TABLE, priority
+                )
+                for table_name, priority in tables
+            ]
+        )
+        logging.info(f"Seeded {added} of {len(tables)} tables into run {self.run_id}")
+        return added
+
+    def claim(self) -> Optional[WorkUnit]:
+        now = time.time()
+        token = uuid.uuid4().hex
+        m = self.marker
+        claimable = f"(status = {m} OR (status = {m} AND lease_expires_at < {m}))"
+        claimable_params = (STATUS_PENDING, STATUS_LEASED, now)
+        # The outer condition is checked again on the row the subquery picked, so two workers
+        # racing for the same unit cannot both take it
+        claimed = self.execute(
+            (
+                f"UPDATE masking_work_unit SET status = {m}, worker_id = {m}, lease_token = {m}, "
+                f"lease_expires_at = {m}, attempts = attempts + 1, updated_at = {m} "
+                f"WHERE run_id = {m} AND {claimable} AND unit_id = ("
+                f"SELECT unit_id FROM masking_work_unit WHERE run_id = {m} AND {claimable} "
+                f"ORDER BY priority DESC, unit_id LIMIT 1{self.db_client.ROW_LOCK_CLAUSE})",
+                (STATUS_LEASED, self.worker_id, token, now + self.lease_seconds, now, self.run_id)
+                + claimable_params
+                + (self.run_id,)
+                + claimable_params,
+            )
+        )
+        if not claimed:
+            return None
+        rows = self.fetch(
+            f"SELECT {UNIT_COLUMNS} FROM masking_work_unit WHERE run_id = {m} AND lease_token = {m}",
+            (self.run_id, token),
+        )
+        if not rows:
+            return None
+        row = rows[0]
+        unit = WorkUnit(
+            unit_id=row[0],
+            table_name=row[1],
+            unit_type=row[2],
+            key_columns=None if row[3] is None else json.loads(row[3]),
+            key_range=(decode_key(row[4]), decode_key(row[5])),
+            last_key=decode_key(row[6]),
+            rows_processed=row[7],
+            attempts=row[8],
+            priority=row[9],
+            lease_token=row[10],
+        )
+        logging.info(f"Worker {self.worker_id} claimed {unit.unit_id} (attempt {unit.attempts})")
+        return unit
+
+    def lease_statement(
+        self, unit: WorkUnit, assignments: str, params: Tuple[Any, ...]
+    ) -> Tuple[str, Tuple[Any, ...]]:
+        # The lease token fences out a worker whose lease expired and was claimed by another
+        m = self.marker
+        return (
+            f"UPDATE masking_work_unit SET {assignments}, updated_at = {m} "
+            f"WHERE run_id = {m} AND unit_id = {m} AND lease_token = {m} AND status = {m}",
+            params + (time.time(), self.run_id, unit.unit_id, unit.lease_token, STATUS_LEASED),
+        )
+
+    def update_lease(self, unit: WorkUnit, assignments: str, params: Tuple[Any, ...]) -> bool:
+        return bool(self.execute(self.lease_statement(unit, assignments, params)))
+
+    def heartbeat(self, unit: WorkUnit) -> bool:
+        return self.update_lease(
+            unit, f"lease_expires_at = {self.marker}", (time.time() + self.lease_seconds,)
+        )
+
+    def progress_statement(
+        self, unit: WorkUnit, last_key: Optional[Tuple[Any, ...]], rows_processed: int
+    ) -> Tuple[str, Tuple[Any, ...]]:
+        m = self.marker
+        return self.lease_statement(
+            unit,
+            f"last_key = {m}, rows_processed = {m}, lease_expires_at = {m}",
+            (encode_key(last_key), rows_processed, time.time() + self.lease_seconds),
+        )
+
+    def save_progress(
+        self, unit: WorkUnit, last_key: Optional[Tuple[Any, ...]], rows_processed: int
+    ) -> None:
+        if not self.execute(self.progress_statement(unit, last_key, rows_processed)):
+            raise LeaseLostError(f"Lease on {unit.unit_id} lost by worker {self.worker_id}")
+
+    def complete(self, unit: WorkUnit, rows_processed: Optional[int] = None) -> bool:
+        m = self.marker
+        assignments = f"status = {m}, lease_expires_at = NULL"
+        params: Tuple[Any, ...] = (STATUS_DONE,)
+        if rows_processed is not None:
+            assignments += f", rows_processed = {m}"
+            params += (rows_processed,)
+        return self.update_lease(unit, assignments, params)
+
+    def split(
+        self, unit: WorkUnit, key_columns: List[str], key_ranges: List[Tuple[Any, Any]]
+    ) -> None:
+        """Replace a table unit by one unit per key range, in the same transaction."""
+        m = self.marker
+        # Ranges are listed after the unplanned tables of the same size, so planning runs ahead
+        range_priority = max(unit.priority // max(len(key_ranges), 1), 0)
+        statements = [
+            self.insert_statement(
+                f"{UNIT_RANGE}:{unit.table_name}:{CheckpointStore.range_id(key_range)}",
+                unit.table_name,
+                UNIT_RANGE,
+                range_priority,
+                key_columns,
+                key_range,
+                held_unit=unit,
+            )
+            for key_range in key_ranges
+        ]
+        statements.append(
+            (
+                f"UPDATE masking_work_unit SET status = {m}, key_columns = {m}, lease_expires_at = NULL, "
+                f"updated_at = {m} WHERE run_id = {m} AND unit_id = {m} AND lease_token = {m} AND status = {m}",
+                (
+                    STATUS_DONE,
+                    json.dumps(key_columns),
+                    time.time(),
+                    self.run_id,
+                    unit.unit_id,
+                    unit.lease_token,
+                    STATUS_LEASED,
+                ),
+            )
+        )
+        # The table unit is marked done in the same transaction, so a worker stopped midway
+        # leaves it unplanned rather than half split
+        if self.execute(*statements) < 1:
+            raise LeaseLostError(f"Lease on {unit.unit_id} lost by worker {self.worker_id}")
+        logging.info(f"{unit.table_name} split into {len(key_ranges)} key ranges")
+
+    def fail(self, unit: WorkUnit, error: str) -> str:
+        # Failed units go back to the queue until they have used up their attempts
+        status = STATUS_FAILED if unit.attempts >= self.max_attempts else STATUS_PENDING
+        m = self.marker
+        self.update_lease(
+            unit, f"status = {m}, error = {m}, lease_expires_at = NULL", (status, error[:4000])
+        )
+        return status
+
+    def release(self, unit: WorkUnit) -> None:
+        # Hands the unit back untouched, e.g. when the worker is stopped, without using an attempt
+        m = self.marker
+        self.update_lease(
+            unit,
+            f"status = {m}, attempts = attempts - 1, lease_expires_at = NULL",
+            (STATUS_PENDING,),
+        )
+
+    def get_status_counts(self) -> Dict[str, int]:
+        m = self.marker
+        rows = self.fetch(
+            f"SELECT status, COUNT(*) FROM masking_work_unit WHERE run_id = {m} GROUP BY status",
+            (self.run_id,),
+        )
+        return {status: count for status, count in rows}
+
+
+class LeasedUnitCheckpoint:
+    """Checkpoint store interface of process_table_in_batches, backed by the leased work unit, so a
+    range taken over from a stopped worker resumes after its last committed key."""
+
+    def __init__(self, work_queue: WorkQueue, unit: WorkUnit):
+        self.work_queue = work_queue
+        self.unit = unit
+        self.rows_processed = unit.rows_processed
+
+    def get_checkpoint(
+        self, table_name: str, key_range: Tuple[Any, Any]
+    ) -> Optional[Dict[str, Any]]:
+        if self.unit.last_key is None and not self.unit.rows_processed:
+            return None
+        return {
+            "last_key": self.unit.last_key,
+            "rows_processed": self.unit.rows_processed,
+            "status": STATUS_LEASED,
+        }
+
+    def get_write_guard(
+        self,
+        db_client: Any,
+        table_name: str,
+        key_range: Tuple[Any, Any],
+        last_key: Optional[Tuple[Any, ...]],
+        rows_processed: int,
+    ) -> Optional[Tuple[str, Tuple[Any, ...]]]:
+        # Written to the queue's own database, the batch commits only while the lease is held and
+        # its progress commits with it, a batch written after losing the lease is rolled back
+        if db_client is not self.work_queue.db_client:
+            return None
+        return self.work_queue.progress_statement(self.unit, last_key, rows_processed)
+
+    def save_progress(
+        self,
+        table_name: str,
+        key_range: Tuple[Any, Any],
+        last_key: Optional[Tuple[Any, ...]],
+        rows_processed: int,
+        status: str = STATUS_LEASED,
+    ) -> None:
+        self.rows_processed = rows_processed
+        # Completion is recorded by the worker once the whole unit has returned
+        if status != STATUS_DONE:
+            self.work_queue.save_progress(self.unit, last_key, rows_processed)